@@ -2,67 +2,149 @@ import os
 import json
 import time
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from fleet import FleetWaiter, INSTANCE_FIELDS
+from auth import TokenProvider
+from inventory import Inventory
+from metrics import Metrics
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level='INFO')
 
-class AuraAPI:
-    def __init__(self, url, tenant_id, token=None, **kwargs):
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class AuraAPIError(Exception):
+    """An error response, after retries, to a request built with `raise_errors=True`."""
+
+    def __init__(self, operation, status, content=b''):
+        self.operation = operation
+        self.status = status
+        super().__init__("{} failed with HTTP {}: {}".format(operation, status,
+                                                             content[:200].decode('utf-8', 'replace')))
+
+
+class AuraRetry(Retry):
+    """Retries 5xx responses for idempotent calls and 429 responses for any call.
+
+    A rate limited request was never processed, so it is safe to resend a POST;
+    a 5xx on a POST might have created an instance, so it is not retried.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def create_session(pool_size=16, retries=5, backoff_factor=0.5, **kwargs):
+    """requests.Session with a keep-alive connection pool shared by all worker threads."""
+    retry = AuraRetry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUSES,
+                      respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class AuraAPIBase:
+    """Request building and response parsing shared by AuraAPI and AsyncAuraAPI.
+
+    Each operation has a `_<op>_request` method returning the keyword arguments for
+    `_request` and a `_parse_<op>` method turning the decoded JSON body into the result.
+    The parse methods also keep `self.inventory` up to date and, when a `journal` is
+    set, record every successful change in it. Every request is recorded in
+    `self.metrics` under the name of its operation.
+    """
+
+    def __init__(self, url, tenant_id, token=None, metrics=None, journal=None, **kwargs):
         self.url = url
-        self.token = token
         self.tenant_id = tenant_id
         self.config = kwargs
+        self.metrics = metrics or Metrics()
+        self.journal = journal
+        auth_config = self.config.get('auth', {})
+        if not token and time.time() - auth_config.get('token_ttl', 0) < 3599:
+            token = auth_config.get('access_token') or None
+        self.tokens = TokenProvider(auth_config.get('endpoint'), auth_config.get('client_id'), token=token,
+                                    cache_file=auth_config.get('cache_file'),
+                                    refresh_margin=auth_config.get('refresh_margin', 300))
+        inventory_config = self.config.get('inventory', {})
+        cache_file = inventory_config.get('cache_file', '')
+        self.inventory = Inventory(ttl=inventory_config.get('ttl', 30),
+                                   cache_file=cache_file.format(tenant_id=tenant_id) if cache_file else None)
+
+    def _headers(self):
+        return {"Content-Type": "application/json"}
+
+    def _record(self, event, **fields):
+        if self.journal is not None:
+            self.journal.record(event, **fields)
+
+    def _list_request(self):
+        # an empty list from a failed call would look like an empty fleet, so failures raise
+        return dict(method='GET', url=self.url, headers={}, params={'tenantId': self.tenant_id}, operation='list',
+                    raise_errors=True)
 
-    def list(self):
-        headers = {"Authorization": self.token}
-        params = {'tenantId': self.tenant_id}
-        response = requests.get(self.url, headers=headers, params=params)
-        res = json.loads(response.content)
+    def _parse_list(self, res):
         instance_list = res.get('data', [])
+        self.inventory.update(instance_list)
         if not instance_list:
             logger.info("No instances found: {}".format(instance_list))
         return instance_list
 
-    def snapshots(self, instance_id, snapshot_date=None):
-        headers = {"Content-Type": "application/json", "Authorization": self.token}
-        _url = os.path.join(self.url, instance_id)
+    def _snapshots_request(self, instance_id, snapshot_date=None):
+        _url = os.path.join(self.url, instance_id, 'snapshots')
         if snapshot_date:
-            _url = os.path.join(_url, 'snapshots?date=' + snapshot_date)
-        response = requests.get(_url, headers=headers)
-        res = json.loads(response.content)
+            _url = _url + '?date=' + snapshot_date
+        return dict(method='GET', url=_url, headers=self._headers(), operation='snapshots')
+
+    def _parse_snapshots(self, res):
         if not res.get('data', {}): 
             logger.info("No snapshots, make sure instance is on")
             return 'Unknown'
-        logger.info(_url)
         snapshots = res.get('data')
         return snapshots
 
-    def status(self, instance_id):
-        headers = {"Content-Type": "application/json", "Authorization": self.token}
-        _url = os.path.join(self.url, instance_id)
-        response = requests.get(_url, headers=headers)
-        res = json.loads(response.content)
+    def _status_request(self, instance_id):
+        # only a 404 means the instance is gone; other errors must not pass for it
+        return dict(method='GET', url=os.path.join(self.url, instance_id), headers=self._headers(),
+                    operation='status', raise_errors=True)
+
+    def _parse_status(self, res, instance_id):
         if not res.get('data'):
             logger.info("Unable to retrieve instance Status : {}".format(instance_id))
             return 'Unknown'
+        self.inventory.update_details(instance_id, res.get('data'))
         status = res.get('data').get('status')
         return status
 
-    def create(self, params):
-        headers = {"Content-Type": "application/json", "Authorization": self.token}
+    def _create_request(self, params):
         params.update({
             'tenant_id': self.tenant_id
         })
-        response = requests.post(self.url, headers=headers, json=params)
-        res = json.loads(response.content)
+        # a failed create may or may not have created the instance, so the caller has to know
+        return dict(method='POST', url=self.url, headers=self._headers(), json=params, operation='create',
+                    raise_errors=True)
+
+    def _parse_create(self, res):
         instance_details = res.get('data', {})
+        self.inventory.invalidate()
         errors = res.get('errors', {})
         if not instance_details:
             logger.info("Instance creation not successful: {}".format(errors))
+            return instance_details
+        self._record('create', name=instance_details.get('name'),
+                     instance={k: v for k, v in instance_details.items() if k in INSTANCE_FIELDS})
         return instance_details
 
-    def clone(self, source_instance_id, target_instance_id, wait=True, time_out=360, snapshot_id=None):
+    def _clone_request(self, source_instance_id, target_instance_id, snapshot_id=None):
         params = {
             "source_instance_id": source_instance_id
         }
@@ -71,10 +153,191 @@ class AuraAPI:
                 "source_snapshot_id": snapshot_id
             })
         _url = os.path.join(self.url, target_instance_id, 'overwrite')
-        headers = {"Content-Type": "application/json", "Authorization": self.token}
-        response = requests.post(_url, headers=headers, json=params)
-        res = json.loads(response.content)
+        return dict(method='POST', url=_url, headers=self._headers(), json=params, operation='clone')
+
+    def _parse_clone(self, res, instance_id):
+        self.inventory.invalidate(instance_id)
+        if res.get('data'):
+            self._record('overwrite', instance_id=instance_id)
+        return res.get('data', {})
+
+    def _pause_request(self, instance_id):
+        return dict(method='POST', url=os.path.join(self.url, instance_id, 'pause'), headers=self._headers(),
+                    operation='pause')
+
+    def _parse_pause(self, res, instance_id):
+        instance_details = res.get('data', {})
+        self.inventory.invalidate(instance_id)
+        errors = res.get('errors', {})
+        if not instance_details:
+            logger.info("Pause not successful: {}".format(errors))
+            return instance_details
+        self._record('pause', instance_id=instance_id)
+        return instance_details
+
+    def _resume_request(self, instance_id):
+        return dict(method='POST', url=os.path.join(self.url, instance_id, 'resume'), headers=self._headers(),
+                    operation='resume')
+
+    def _parse_resume(self, res, instance_id):
+        self.inventory.invalidate(instance_id)
+        if res.get('data'):
+            self._record('resume', instance_id=instance_id)
+        return res.get('data', {})
+
+    def _delete_request(self, instance_id):
+        return dict(method='DELETE', url=os.path.join(self.url, instance_id), headers=self._headers(),
+                    operation='delete')
+
+    def _parse_delete(self, res):
         instance_details = res.get('data', {})
+        self.inventory.invalidate()
+        errors = res.get('errors', {})
+        if not instance_details:
+            logger.info("Instance not found or unable to delete: {}".format(errors))
+            return dict()
+        self._record('delete', instance_id=instance_details.get('id'))
+        return instance_details
+
+    def _token_request(self):
+        auth_config = self.config['auth']
+        body = {
+            "grant_type": "client_credentials"
+        }
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        return dict(method='POST', url=auth_config.get('endpoint'), headers=headers, data=body,
+                    auth=(auth_config.get('client_id'), auth_config.get('client_secret')), authenticate=False,
+                    operation='token')
+
+    @property
+    def token(self):
+        return self.tokens.token
+
+    def _can_refresh(self):
+        # a token passed in without client credentials cannot be refreshed
+        return bool(self.config.get('auth', {}).get('client_id'))
+
+    def _token_expired(self):
+        return self._can_refresh() and self.tokens.due()
+
+    def _authorize(self, headers, token):
+        return dict(headers or {}, Authorization=token)
+
+    def _set_token(self, data):
+        self.tokens.update(data)
+        self.config['auth']['access_token'] = self.token
+        self.config['auth']['token_ttl'] = time.time()
+        logger.info("Token Generation Successful: {}".format(time.ctime()))
+
+
+class AuraAPI(AuraAPIBase):
+    def __init__(self, url, tenant_id, token=None, metrics=None, journal=None, **kwargs):
+        super().__init__(url, tenant_id, token=token, metrics=metrics, journal=journal, **kwargs)
+        http_config = self.config.get('http', {})
+        self.timeout = (http_config.get('connect_timeout', 5), http_config.get('read_timeout', 30))
+        # Headers and tokens are passed per request, so the session itself is never
+        # mutated after this point and can be shared by worker threads.
+        self.session = create_session(**http_config)
+        self.token_lock = threading.Lock()
+        self.refresher = None
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+        self.session.close()
+
+    def _ensure_token(self):
+        if self._token_expired():
+            with self.token_lock:
+                if self._token_expired():
+                    self._set_token(self._request(**self._token_request()))
+        if self.refresher is None and self._can_refresh():
+            self.refresher = threading.Thread(target=self._refresh_token_loop, daemon=True)
+            self.refresher.start()
+
+    def _refresh_token_loop(self):
+        """Renews the token in the background shortly before it expires."""
+        # re-checked at least every minute in case the token was replaced in the meantime
+        while not self.closed.wait(min(self.tokens.refresh_in(), 60)):
+            try:
+                with self.token_lock:
+                    if self._token_expired():
+                        self._set_token(self._request(**self._token_request()))
+            except Exception as e:
+                logger.info("Background token refresh failed, retrying: {}".format(e))
+                self.closed.wait(30)
+
+    def _request(self, method, url, headers=None, authenticate=True, operation=None, raise_errors=False, **kwargs):
+        # A rejected token is renewed and the request sent once more
+        for attempt in range(2):
+            request_headers = headers
+            if authenticate:
+                self._ensure_token()
+                token = self.token
+                request_headers = self._authorize(headers, token)
+            response = self._send(operation or method, method, url, headers=request_headers, **kwargs)
+            if response.status_code != 401 or not authenticate or attempt:
+                break
+            logger.info("Access token rejected, requesting a new one")
+            self.tokens.invalidate(token)
+        if raise_errors and response.status_code >= 400:
+            raise AuraAPIError(operation or method, response.status_code, response.content)
+        if not response.content:
+            return dict()
+        return json.loads(response.content)
+
+    def _send(self, operation, method, url, **kwargs):
+        start = time.perf_counter()
+        status = None
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            if status is None:
+                self.metrics.observe(operation, elapsed)
+            else:
+                # statuses of the attempts urllib3 retried before this response
+                history = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+                body = response.request.body or b''
+                self.metrics.observe(operation, elapsed, status, sent=len(body), received=len(response.content),
+                                     retries=len(history),
+                                     rate_limited=[h.status for h in history].count(429) + (status == 429))
+
+    def list(self, refresh=False):
+        instance_list = None if refresh else self.inventory.list()
+        if instance_list is None:
+            instance_list = self._parse_list(self._request(**self._list_request()))
+        return instance_list
+
+    def find(self, prefix):
+        """Instances named `<prefix>_...`, from the cached inventory."""
+        self.list()
+        return self.inventory.with_prefix(prefix)
+
+    def snapshots(self, instance_id, snapshot_date=None):
+        return self._parse_snapshots(self._request(**self._snapshots_request(instance_id, snapshot_date)))
+
+    def status(self, instance_id, refresh=False):
+        """Status of the instance, 'Unknown' if it does not exist; other errors raise AuraAPIError."""
+        status = None if refresh else self.inventory.status(instance_id)
+        if status is None:
+            try:
+                res = self._request(**self._status_request(instance_id))
+            except AuraAPIError as e:
+                if e.status != 404:
+                    raise
+                res = dict()
+            status = self._parse_status(res, instance_id)
+        return status
+
+    def create(self, params):
+        return self._parse_create(self._request(**self._create_request(params)))
+
+    def clone(self, source_instance_id, target_instance_id, wait=True, time_out=360, snapshot_id=None):
+        res = self._request(**self._clone_request(source_instance_id, target_instance_id, snapshot_id))
+        instance_details = self._parse_clone(res, target_instance_id)
         if wait:
             status = self.__wait(target_instance_id, status='running', time_out=time_out)
             if status != 'running':
@@ -82,14 +345,7 @@ class AuraAPI:
         return instance_details
 
     def pause(self, instance_id, wait=False):
-        _url = os.path.join(self.url, instance_id, 'pause')
-        headers = {"Content-Type": "application/json", "Authorization": self.token}
-        response = requests.post(_url, headers=headers)
-        res = json.loads(response.content)
-        instance_details = res.get('data', {})
-        errors = res.get('errors', {})
-        if not instance_details:
-            logger.info("Pause not successful: {}".format(errors))
+        instance_details = self._parse_pause(self._request(**self._pause_request(instance_id)), instance_id)
         if wait:
             status = self.__wait(instance_id, status='paused')
             if status != 'paused':
@@ -98,11 +354,7 @@ class AuraAPI:
         return instance_details
 
     def resume(self, instance_id, wait=True):
-        _url = os.path.join(self.url, instance_id, 'resume')
-        headers = {"Content-Type": "application/json", "Authorization": self.token}
-        response = requests.post(_url, headers=headers)
-        res = json.loads(response.content)
-        instance_details = res.get('data', {})
+        instance_details = self._parse_resume(self._request(**self._resume_request(instance_id)), instance_id)
         if wait:
             status = self.__wait(instance_id, status='running')
             if status != 'running':
@@ -111,46 +363,20 @@ class AuraAPI:
         return instance_details
 
     def delete(self, instance_id):
-        _url = os.path.join(self.url, instance_id)
-        headers = {"Content-Type": "application/json", "Authorization": self.token}
-        response = requests.delete(_url, headers=headers)
-        res = json.loads(response.content)
-        instance_details = res.get('data', {})
-        errors = res.get('errors', {})
-        if not instance_details:
-            logger.info("Instance not found or unable to delete: {}".format(errors))
-            return dict()
-        return instance_details
-
-    def __generate_token(self, url, client_id, client_secret):
-        body = {
-            "grant_type": "client_credentials"
-        }
-        headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        response = requests.post(url, auth=(client_id, client_secret), headers=headers, data=body)
-        data = json.loads(response.content)
-        token = data['access_token']
-        return token
+        return self._parse_delete(self._request(**self._delete_request(instance_id)))
 
     def generate_token_if_expired(self):
-        auth_config = self.config['auth']
-        auth_url = auth_config.get('endpoint')
-        client_id = auth_config.get('client_id')
-        client_secret = auth_config.get('client_secret')
-        if time.time() - auth_config.get('token_ttl') >= 3599:
-            self.token = self.__generate_token(auth_url, client_id, client_secret)
-            self.config['auth']['access_token'] = self.token
-            self.config['auth']['token_ttl'] = time.time()
-            logger.info("Token Generation Successful: {}".format(time.ctime()))
+        if self._token_expired():
+            self._set_token(self._request(**self._token_request()))
             return True
         logger.info("Token is Valid")
         return False
 
-    def __wait(self, instance_id, status=None, time_out=300):
-        start = time.time()
-        current_status = self.status(instance_id)
-        while current_status != status and time.time() - start <= time_out:
-            time.sleep(60)
-            current_status = self.status(instance_id)
-            logger.info("Waiting: {} {}".format(instance_id, status))
-        return current_status
+    def wait(self, instance_ids, status='running', time_out=None):
+        """Wait until every instance in `instance_ids` reaches `status`; returns {instance_id: status}."""
+        waiter = FleetWaiter(self, **self.config.get('wait', {}))
+        with self.metrics.span('wait ' + status):
+            return waiter.wait(instance_ids, status=status, time_out=time_out)
+
+    def __wait(self, instance_id, status=None, time_out=None):
+        return self.wait([instance_id], status=status, time_out=time_out).get(instance_id)
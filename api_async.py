@@ -0,0 +1,250 @@
+import json
+import time
+import asyncio
+import logging
+from urllib.parse import urlencode
+
+import aiohttp
+
+from api import AuraAPIBase, AuraAPIError, RETRY_STATUSES
+from fleet import FleetWaiter
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+
+class AsyncAuraAPI(AuraAPIBase):
+    """asyncio counterpart of AuraAPI.
+
+    At most `max_concurrency` requests are in flight at once. Use as an async context
+    manager so the underlying connection pool is closed:
+
+        async with AsyncAuraAPI(url, tenant_id, **config) as api:
+            statuses = await api.status_many(instance_ids)
+    """
+
+    def __init__(self, url, tenant_id, token=None, metrics=None, journal=None, **kwargs):
+        super().__init__(url, tenant_id, token=token, metrics=metrics, journal=journal, **kwargs)
+        http_config = self.config.get('http', {})
+        self.max_concurrency = http_config.get('max_concurrency', 50)
+        self.retries = http_config.get('retries', 5)
+        self.backoff_factor = http_config.get('backoff_factor', 0.5)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=http_config.get('connect_timeout', 5),
+                                             sock_read=http_config.get('read_timeout', 30))
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.token_lock = asyncio.Lock()
+        self.refresher = None
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.refresher is not None:
+            self.refresher.cancel()
+            self.refresher = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _ensure_token(self):
+        if self._token_expired():
+            async with self.token_lock:
+                if self._token_expired():
+                    self._set_token(await self._request(**self._token_request()))
+        if self.refresher is None and self._can_refresh():
+            self.refresher = asyncio.ensure_future(self._refresh_token_loop())
+
+    async def _refresh_token_loop(self):
+        """Renews the token in the background shortly before it expires."""
+        while True:
+            # re-checked at least every minute in case the token was replaced in the meantime
+            await asyncio.sleep(min(self.tokens.refresh_in(), 60))
+            try:
+                async with self.token_lock:
+                    if self._token_expired():
+                        self._set_token(await self._request(**self._token_request()))
+            except Exception as e:
+                logger.info("Background token refresh failed, retrying: {}".format(e))
+                await asyncio.sleep(30)
+
+    async def _request(self, method, url, headers=None, authenticate=True, operation=None, raise_errors=False,
+                       **kwargs):
+        # A rejected token is renewed and the request sent once more
+        for attempt in range(2):
+            request_headers = headers
+            if authenticate:
+                await self._ensure_token()
+                token = self.token
+                request_headers = self._authorize(headers, token)
+            status, content = await self._send(operation or method, method, url, headers=request_headers, **kwargs)
+            if status != 401 or not authenticate or attempt:
+                break
+            logger.info("Access token rejected, requesting a new one")
+            self.tokens.invalidate(token)
+        if raise_errors and status >= 400:
+            raise AuraAPIError(operation or method, status, content)
+        if not content:
+            return dict()
+        return json.loads(content)
+
+    async def _send(self, operation, method, url, auth=None, **kwargs):
+        if auth is not None:
+            auth = aiohttp.BasicAuth(*auth)
+        body_size = len(json.dumps(kwargs['json'])) if kwargs.get('json') is not None else \
+            len(urlencode(kwargs.get('data') or {}))
+        start = time.perf_counter()
+        sent = received = rate_limited = 0
+        status = None
+        # Same policy as AuraRetry: 429 and connection errors for any call, 5xx and other
+        # transport errors only for idempotent calls
+        for attempt in range(self.retries + 1):
+            sent += body_size
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, auth=auth, **kwargs) as response:
+                        content = await response.read()
+                        retry_after = response.headers.get('Retry-After')
+                        status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = isinstance(e, aiohttp.ClientConnectorError) or method != 'POST'
+                if not retryable or attempt == self.retries:
+                    self.metrics.observe(operation, time.perf_counter() - start, sent=sent, received=received,
+                                         retries=attempt, rate_limited=rate_limited)
+                    raise
+                delay = self.backoff_factor * (2 ** attempt)
+                logger.info("Retrying {} {} after {}s ({})".format(method, url, delay, e.__class__.__name__))
+                await asyncio.sleep(delay)
+                continue
+            received += len(content)
+            rate_limited += status == 429
+            retryable = status == 429 or (status in RETRY_STATUSES and method != 'POST')
+            if not retryable or attempt == self.retries:
+                break
+            delay = self.backoff_factor * (2 ** attempt)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logger.info("Retrying {} {} after {}s (status {})".format(method, url, delay, status))
+            await asyncio.sleep(delay)
+        self.metrics.observe(operation, time.perf_counter() - start, status, sent=sent, received=received,
+                             retries=attempt, rate_limited=rate_limited)
+        return status, content
+
+    async def list(self, refresh=False):
+        instance_list = None if refresh else self.inventory.list()
+        if instance_list is None:
+            instance_list = self._parse_list(await self._request(**self._list_request()))
+        return instance_list
+
+    async def find(self, prefix):
+        await self.list()
+        return self.inventory.with_prefix(prefix)
+
+    async def snapshots(self, instance_id, snapshot_date=None):
+        return self._parse_snapshots(await self._request(**self._snapshots_request(instance_id, snapshot_date)))
+
+    async def status(self, instance_id, refresh=False):
+        status = None if refresh else self.inventory.status(instance_id)
+        if status is None:
+            try:
+                res = await self._request(**self._status_request(instance_id))
+            except AuraAPIError as e:
+                if e.status != 404:
+                    raise
+                res = dict()
+            status = self._parse_status(res, instance_id)
+        return status
+
+    async def create(self, params):
+        return self._parse_create(await self._request(**self._create_request(params)))
+
+    async def clone(self, source_instance_id, target_instance_id, wait=True, time_out=360, snapshot_id=None):
+        res = await self._request(**self._clone_request(source_instance_id, target_instance_id, snapshot_id))
+        instance_details = self._parse_clone(res, target_instance_id)
+        if wait:
+            status = (await self.wait([target_instance_id], status='running', time_out=time_out))[target_instance_id]
+            if status != 'running':
+                logger.info("Instance is not cloned yet: {} {}".format(target_instance_id, status))
+        return instance_details
+
+    async def pause(self, instance_id, wait=False):
+        instance_details = self._parse_pause(await self._request(**self._pause_request(instance_id)), instance_id)
+        if wait:
+            status = (await self.wait([instance_id], status='paused'))[instance_id]
+            if status != 'paused':
+                logger.info("Instance is not paused yet: {} {}".format(instance_id, status))
+                return dict()
+        return instance_details
+
+    async def resume(self, instance_id, wait=True):
+        instance_details = self._parse_resume(await self._request(**self._resume_request(instance_id)), instance_id)
+        if wait:
+            status = (await self.wait([instance_id], status='running'))[instance_id]
+            if status != 'running':
+                logger.info("Instance is not ready yet: {} {}".format(instance_id, status))
+                return dict()
+        return instance_details
+
+    async def delete(self, instance_id):
+        return self._parse_delete(await self._request(**self._delete_request(instance_id)))
+
+    async def generate_token_if_expired(self):
+        if self._token_expired():
+            self._set_token(await self._request(**self._token_request()))
+            return True
+        logger.info("Token is Valid")
+        return False
+
+    async def wait(self, instance_ids, status='running', time_out=None):
+        """Async version of FleetWaiter.wait: one list() per tick with the same adaptive backoff."""
+        waiter = FleetWaiter(self, **self.config.get('wait', {}))
+        time_out = waiter.time_out if time_out is None else time_out
+        deadline = time.monotonic() + time_out
+        pending = set(instance_ids)
+        statuses = dict()
+        interval = waiter.min_interval
+        while pending:
+            try:
+                listed = {d['id']: d.get('status') for d in await self.list(refresh=True) if d.get('id') in pending}
+            except Exception as e:
+                logger.info("Status check failed, retrying: {}".format(e))
+                listed = dict()
+            missing = [instance_id for instance_id in pending if not listed.get(instance_id)]
+            for instance_id, result in zip(missing, await self._gather([self.status(i, refresh=True)
+                                                                         for i in missing], missing)):
+                if result is not None:
+                    listed[instance_id] = result
+            changed = any(statuses.get(i) != listed.get(i) for i in pending if i in listed)
+            statuses.update(listed)
+            pending = {i for i in pending if statuses.get(i) != status}
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                break
+            interval = waiter.next_interval(interval, changed)
+            await asyncio.sleep(min(interval, remaining))
+        return {instance_id: statuses.get(instance_id) for instance_id in instance_ids}
+
+    async def _gather(self, calls, instance_ids):
+        """Results of `calls`, one per instance; a call that raised is logged and gives None."""
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        for instance_id, result in zip(instance_ids, results):
+            if isinstance(result, Exception):
+                logger.info("Call failed: {} {}".format(instance_id, result))
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    async def status_many(self, instance_ids):
+        return dict(zip(instance_ids, await self._gather([self.status(i) for i in instance_ids], instance_ids)))
+
+    async def pause_many(self, instance_ids):
+        return await self._gather([self.pause(i) for i in instance_ids], instance_ids)
+
+    async def resume_many(self, instance_ids):
+        return await self._gather([self.resume(i, wait=False) for i in instance_ids], instance_ids)
+
+    async def delete_many(self, instance_ids):
+        return await self._gather([self.delete(i) for i in instance_ids], instance_ids)
@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# Providers of several clients (e.g. shards) share one cache file; one of them writes at a time
+CACHE_LOCK = threading.Lock()
+
+
+class TokenProvider:
+    """Holds the Aura API access token and its expiry, optionally cached on disk.
+
+    The cache file is readable by the current user only and keyed by a hash of the
+    token endpoint and client id; the client secret is never written. A token is
+    considered due for refresh `refresh_margin` seconds before it expires, so callers
+    can renew it before a request is ever rejected.
+    """
+
+    def __init__(self, endpoint=None, client_id=None, token=None, cache_file=None, refresh_margin=300):
+        self.endpoint = endpoint
+        self.client_id = client_id
+        self.cache_file = os.path.expanduser(cache_file) if cache_file else None
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.token = token
+        self.expires_at = float('inf') if token else 0.0
+        if not token:
+            self._load()
+
+    @property
+    def key(self):
+        return hashlib.sha256('{} {}'.format(self.endpoint, self.client_id).encode()).hexdigest()
+
+    def valid(self):
+        return bool(self.token) and time.time() < self.expires_at
+
+    def due(self):
+        return not self.token or time.time() >= self.expires_at - self.refresh_margin
+
+    def refresh_in(self):
+        return max(0.0, self.expires_at - self.refresh_margin - time.time())
+
+    def update(self, data):
+        with self.lock:
+            self.token = data['access_token']
+            self.expires_at = time.time() + float(data.get('expires_in', 3600))
+            self._save()
+        return self.token
+
+    def invalidate(self, token=None):
+        """Drop the current token, unless it was already replaced since `token` was used."""
+        with self.lock:
+            if token is None or token == self.token:
+                self.token = None
+                self.expires_at = 0.0
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _load(self):
+        if not self.cache_file or not self.client_id:
+            return
+        cached = self._read_cache().get(self.key, {})
+        if cached.get('expires_at', 0) > time.time():
+            self.token = cached['access_token']
+            self.expires_at = cached['expires_at']
+            logger.info("Using cached access token, valid until {}".format(time.ctime(self.expires_at)))
+
+    def _save(self):
+        if not self.cache_file or not self.client_id:
+            return
+        directory = os.path.dirname(self.cache_file)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        with CACHE_LOCK:
+            cache = {k: v for k, v in self._read_cache().items() if v.get('expires_at', 0) > time.time()}
+            cache[self.key] = {'access_token': self.token, 'expires_at': self.expires_at}
+            # a temp file of its own (created 0600), so other processes never write into it
+            fd, tmp_file = tempfile.mkstemp(dir=directory or '.', prefix=os.path.basename(self.cache_file) + '.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(cache, f)
+                os.replace(tmp_file, self.cache_file)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import logging
+import argparse
+
+from api import AuraAPI
+from records import print_records
+from simulator import AuraSimulator
+from metrics import percentile
+import main
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+OPERATIONS = ['create', 'clone', 'status', 'pause', 'delete']
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Time main.py tasks against the local Aura API simulator")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help="fleet sizes to run")
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--latency', type=float, default=0.05, help="simulated seconds per API response")
+    parser.add_argument('--rate-limit', type=float, default=0, help="simulated API rate limit (requests/s)")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of simulated 500 responses")
+    parser.add_argument('--workers', type=int, default=None, help="override create/clone workers from config.json")
+    parser.add_argument('--config', default='config.json', help="config used for the http/wait/inventory settings")
+    parser.add_argument('--output', default='', help="write the results as JSON to this file")
+    return parser.parse_args()
+
+
+def run_operation(api, operation, size, task_config, source_instance_id):
+    # the other operations act on the whole `bench` fleet (bench_create_..., bench_clone_...)
+    prefix = 'bench_' + operation if operation in ['create', 'clone'] else 'bench'
+    if operation == 'create':
+        return main.create_instances(api, output_file=os.devnull, **dict(task_config, dbname_prefix=prefix,
+                                                                           num_instances=size))
+    if operation == 'clone':
+        params = dict(task_config['params'], source_instance_id=source_instance_id, source_snapshot_id='')
+        return main.clone_instances(api, output_file=os.devnull, **dict(task_config, dbname_prefix=prefix,
+                                                                          num_instances=size, params=params))
+    fleet_config = {'instance_ids': [], 'dbname_prefix': prefix, 'exclude': [source_instance_id],
+                    'workers': task_config['workers'], 'rate_limit': 0, 'progress': False}
+    if operation == 'status':
+        return main.instance_statuses(api, **fleet_config)
+    if operation == 'pause':
+        return main.pause_instances(api, **fleet_config)
+    if operation == 'delete':
+        return main.delete_instances(api, **fleet_config)
+
+
+def benchmark(size, operations, config, latency=0.05, rate_limit=0, error_rate=0, workers=None):
+    """Run `operations` in order against a fresh simulated tenant; one result row per operation."""
+    simulator = AuraSimulator(latency=latency, transition_delay=0, rate_limit=rate_limit,
+                              error_rate=error_rate).start()
+    config = json.loads(json.dumps(config))
+    config['auth'].update(endpoint=simulator.url + '/oauth/token', client_id='benchmark',
+                          client_secret='benchmark', cache_file='', access_token='', token_ttl=0)
+    config.setdefault('inventory', {})['cache_file'] = ''
+    config.setdefault('snapshots', {})['cache_file'] = ''
+    task_config = dict(config['create'], rate_limit=0)
+    if workers:
+        task_config['workers'] = workers
+    api = AuraAPI(simulator.url + '/v1/instances', 'benchmark-tenant', **config)
+    source = simulator.add_instance('bench_source', status='running')
+
+    results = list()
+    try:
+        for operation in operations:
+            simulator.reset_counts()
+            api.metrics.reset()
+            start = time.perf_counter()
+            instances = run_operation(api, operation, size, task_config, source['id'])
+            elapsed = time.perf_counter() - start
+            latencies = [t for stats in api.metrics.operations.values() for t in stats.latencies]
+            results.append({
+                'operation': operation,
+                'size': size,
+                'instances': len(instances or []),
+                'wall_s': round(elapsed, 3),
+                'requests': simulator.request_count(),
+                'errors': simulator.error_count(),
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+            })
+            logger.info("Benchmark {} x{}: {}s".format(operation, size, results[-1]['wall_s']))
+    finally:
+        api.close()
+        simulator.stop()
+    return results
+
+
+if __name__ == '__main__':
+    args = cli()
+    # per-instance progress logs from the tasks would drown the results
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+
+    results = list()
+    for size in args.sizes:
+        results += benchmark(size, args.operations, config, latency=args.latency, rate_limit=args.rate_limit,
+                             error_rate=args.error_rate, workers=args.workers)
+    print_records(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
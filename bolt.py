@@ -0,0 +1,61 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+
+class SocketLimit:
+    """Caps the number of Bolt connections open at once across worker threads.
+
+    Hold it for as long as a driver may have a connection open. A limit of 0 means
+    no limit.
+    """
+
+    def __init__(self, max_sockets=0):
+        self.semaphore = threading.BoundedSemaphore(max_sockets) if max_sockets else None
+
+    def __enter__(self):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+
+def open_driver(uri, auth, connection_timeout=5.0, max_connections=1):
+    """Driver for one instance with a pool of at most `max_connections` sockets.
+
+    Use it as a context manager so the pool is closed as soon as the work on the
+    instance is done. `connection_timeout` bounds how long a dead or unreachable
+    instance can hold up the caller.
+    """
+    # imported here so tasks that never connect do not load the driver
+    from neo4j import GraphDatabase
+    return GraphDatabase.driver(uri, auth=auth, max_connection_pool_size=max_connections,
+                                connection_timeout=connection_timeout,
+                                connection_acquisition_timeout=2 * connection_timeout)
+
+
+def probe(session):
+    """Run `RETURN 1` on an open session; returns the round trip in seconds."""
+    start = time.perf_counter()
+    session.run('RETURN 1').consume()
+    return time.perf_counter() - start
+
+
+def verify_password(driver, uri, auth, connection_timeout=5.0):
+    """True if `auth` is accepted by the instance behind `driver`."""
+    from neo4j.exceptions import AuthError
+    try:
+        if hasattr(driver, 'verify_authentication'):
+            return driver.verify_authentication(auth)
+        # drivers before 5.8 need a separate pool to try other credentials
+        with open_driver(uri, auth, connection_timeout=connection_timeout) as other:
+            other.verify_connectivity()
+        return True
+    except AuthError:
+        return False
@@ -0,0 +1,147 @@
+import sys
+import time
+import logging
+import threading
+
+from fleet import FleetWaiter, map_concurrently
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# Status an instance must have for the operation (None: any status it can be found with),
+# the status that means it is done and how that is reported. A deleted instance is no
+# longer found, which status() reports as 'Unknown'; a failed lookup is None.
+OPERATIONS = {
+    'pause': {'eligible': ['running'], 'done': 'paused', 'label': 'paused'},
+    'resume': {'eligible': ['paused'], 'done': 'running', 'label': 'running'},
+    'delete': {'eligible': None, 'done': 'Unknown', 'label': 'deleted'},
+}
+
+
+def eligible_for(operation, status):
+    eligible = OPERATIONS[operation]['eligible']
+    if eligible is None:
+        return status not in ['destroying', 'Unknown', None]
+    return status in eligible
+
+
+class ProgressTable:
+    """Number of instances in each state of a bulk operation.
+
+    On a terminal the table is redrawn in place every `interval` seconds; otherwise
+    (e.g. output piped to a file) one summary line is logged per `log_interval` seconds.
+    """
+
+    def __init__(self, title, states, interval=0.5, log_interval=10, stream=None):
+        self.title = title
+        self.states = dict()
+        self.order = list(states)
+        self.interval = interval
+        self.log_interval = log_interval
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.start_time = time.monotonic()
+        self.drawn = 0
+        self.thread = None
+
+    def set(self, key, state):
+        with self.lock:
+            self.states[key] = state
+
+    def counts(self):
+        with self.lock:
+            states = list(self.states.values())
+        names = self.order + sorted(set(states) - set(self.order))
+        return [(name, states.count(name)) for name in names if states.count(name)]
+
+    def render(self):
+        lines = ["{} ({:.0f}s)".format(self.title, time.monotonic() - self.start_time)]
+        lines += ["  {:<12} {:>6}".format(name, count) for name, count in self.counts()]
+        if self.drawn:
+            # move back to the first line of the previous table and clear it
+            self.stream.write('\x1b[{}F\x1b[J'.format(self.drawn))
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+        self.drawn = len(lines)
+
+    def _loop(self):
+        last_log = 0.0
+        while not self.stopped.wait(self.interval):
+            if self.tty:
+                self.render()
+            elif time.monotonic() - last_log >= self.log_interval:
+                last_log = time.monotonic()
+                logger.info("{}: {}".format(self.title, ', '.join('{} {}'.format(n, c) for n, c in self.counts())))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.tty:
+            self.render()
+
+
+def bulk_operation(api, operation, instance_ids, workers=8, rate_limit=0, wait=False, time_out=None,
+                   progress=True):
+    """Pause, resume or delete many instances at once.
+
+    Eligibility is decided from one status snapshot of the whole fleet; the eligible
+    instances are changed concurrently by `workers` threads, throttled to `rate_limit`
+    requests per second. With `wait`, returns once every accepted instance has
+    reached its final status or `time_out` expired. Returns one row per instance.
+    """
+    spec = OPERATIONS[operation]
+    instance_ids = list(dict.fromkeys(instance_ids))
+    waiter = FleetWaiter(api, **dict(api.config.get('wait', {}), workers=workers))
+    table = ProgressTable("{} {} instances".format(operation, len(instance_ids)),
+                          ['skipped', 'pending', 'accepted', 'failed', spec['label'], 'timed out'])
+    rows = {instance_id: {'instance_id': instance_id, 'name': api.inventory.get(instance_id).get('name', ''),
+                          'status_before': '', 'result': ''} for instance_id in instance_ids}
+
+    statuses = waiter.poll(instance_ids)
+    eligible = list()
+    for instance_id in instance_ids:
+        status = statuses.get(instance_id)
+        rows[instance_id]['status_before'] = status or 'failed'
+        if eligible_for(operation, status):
+            eligible.append(instance_id)
+            table.set(instance_id, 'pending')
+        else:
+            rows[instance_id]['result'] = 'skipped'
+            table.set(instance_id, 'skipped')
+    logger.info("{}: {} of {} instances eligible".format(operation, len(eligible), len(instance_ids)))
+
+    if progress:
+        table.start()
+    try:
+        calls = {
+            'pause': lambda i: api.pause(i, wait=False),
+            'resume': lambda i: api.resume(i, wait=False),
+            'delete': api.delete,
+        }
+        accepted = list()
+        for instance_id, data in map_concurrently(calls[operation], eligible, workers=workers,
+                                                  rate_limit=rate_limit):
+            result = 'accepted' if data else 'failed'
+            rows[instance_id]['result'] = result
+            table.set(instance_id, result)
+            if data:
+                accepted.append(instance_id)
+
+        if wait and accepted:
+            with api.metrics.span('wait ' + spec['label']):
+                for instance_id, status in waiter.iter_wait(accepted, status=spec['done'], time_out=time_out):
+                    finished = status == spec['done']
+                    rows[instance_id]['result'] = spec['label'] if finished else 'timed out'
+                    rows[instance_id]['status'] = spec['label'] if finished else status or 'failed'
+                    table.set(instance_id, rows[instance_id]['result'])
+    finally:
+        if progress:
+            table.stop()
+    return list(rows.values())
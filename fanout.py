@@ -0,0 +1,62 @@
+import time
+import logging
+
+from fleet import FleetWaiter, map_concurrently
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+
+def overwrite_in_waves(api, sources, targets, per_source=4, max_wave=50, grow=True, time_out=None):
+    """Overwrite `targets` with the data of `sources` in waves.
+
+    Each wave overwrites up to `per_source` targets from every source (at most
+    `max_wave` in total) and waits until they are running again. With `grow`, the
+    targets of a wave are sources for the next one, so the number of copies roughly
+    multiplies by `per_source + 1` per wave while no single instance serves more
+    than `per_source` overwrites at a time.
+
+    Returns (waves, cloned, failed): one timing row per wave and the target ids.
+    """
+    waiter = FleetWaiter(api, **api.config.get('wait', {}))
+    sources = list(dict.fromkeys(sources))
+    cloned = list()
+    failed = list()
+    waves = list()
+
+    # Instances can only be overwritten, or cloned from, while they are running
+    statuses = waiter.wait(sources + list(targets), status='running', time_out=time_out)
+    sources = [s for s in sources if statuses.get(s) == 'running']
+    pending = [t for t in targets if statuses.get(t) == 'running']
+    failed += [t for t in targets if statuses.get(t) != 'running']
+    if failed:
+        logger.info("Instances not running, not overwriting them: {}".format(failed))
+
+    while pending and sources:
+        width = min(len(pending), len(sources) * per_source, max_wave or len(pending))
+        batch, pending = pending[:width], pending[width:]
+        pairs = [(sources[i % len(sources)], target) for i, target in enumerate(batch)]
+        wave = len(waves) + 1
+        logger.info("Wave {}: overwriting {} instances from {} sources".format(wave, len(batch), len(sources)))
+
+        start = time.monotonic()
+        with api.metrics.span('wave {}'.format(wave)):
+            accepted = [target for (source, target), data in
+                        map_concurrently(lambda pair: api.clone(pair[0], pair[1], wait=False), pairs,
+                                         workers=width) if data]
+            statuses = waiter.wait(accepted, status='running', time_out=time_out)
+        done = [target for target in accepted if statuses.get(target) == 'running']
+        elapsed = time.monotonic() - start
+
+        cloned += done
+        failed += [target for target in batch if target not in done]
+        if grow:
+            sources += done
+        waves.append({'wave': wave, 'sources': len({source for source, _ in pairs}), 'targets': len(batch),
+                      'cloned': len(done), 'failed': len(batch) - len(done), 'seconds': round(elapsed, 1)})
+        logger.info("Wave {}: {} of {} instances cloned in {:.0f}s".format(wave, len(done), len(batch), elapsed))
+
+    if pending:
+        logger.info("No source instance left to clone from: {}".format(pending))
+        failed += pending
+    return waves, cloned, failed
@@ -0,0 +1,207 @@
+import time
+import random
+import string
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+INSTANCE_FIELDS = ['id', 'connection_url', 'name', 'username', 'password']
+
+
+class RateLimiter:
+    """Spaces out calls shared by several worker threads. A rate of 0 disables the limit."""
+
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def new_instance_names(prefix, num, existing_names=(), length=7):
+    """`num` names of the form <prefix>_<random suffix> that are not in `existing_names`."""
+    taken = set(existing_names)
+    names = list()
+    while len(names) < num:
+        suffix = ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
+        db_name = '_'.join([prefix, suffix])
+        if db_name in taken:
+            logger.info("Instance already exists, picking another name: {}".format(db_name))
+            continue
+        taken.add(db_name)
+        names.append(db_name)
+    return names
+
+
+def map_concurrently(func, items, workers=8, rate_limit=0):
+    """Call `func(item)` for every item on a worker pool; yields (item, result) as each finishes.
+
+    Exceptions are logged and yielded as a None result, so one failure does not stop the batch.
+    """
+    limiter = RateLimiter(rate_limit)
+
+    def _call(item):
+        limiter.acquire()
+        try:
+            return func(item)
+        except Exception as e:
+            logger.info("Call failed: {} {}".format(item, e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(_call, item): item for item in items}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def provision(api, names, params, workers=4, rate_limit=1.0, retries=2, retry_delay=5, on_result=None,
+              params_by_name=None):
+    """Create one instance per name with a bounded worker pool.
+
+    Instances are created with `params`, or with `params_by_name[name]` where given.
+    `on_result` is called from the calling thread with the instance details as soon as
+    each instance is accepted by the API. Rate limited requests are sent again; after
+    any other failure the instance may exist anyway, so the request is only sent again
+    if no instance with that name is listed. Returns (created, failed_names).
+    """
+    params_by_name = params_by_name or {}
+    limiter = RateLimiter(rate_limit)
+
+    def _create(name):
+        from api import AuraAPIError
+
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(retry_delay * attempt)
+                logger.info("Retrying instance creation: {} attempt {}".format(name, attempt + 1))
+            limiter.acquire()
+            try:
+                data = api.create(params=dict(params_by_name.get(name, params), name=name))
+                if data:
+                    return data
+                logger.info("Instance creation returned no instance: {}".format(name))
+            except AuraAPIError as e:
+                logger.info("Instance creation failed: {} {}".format(name, e))
+                if e.status == 429:
+                    # rate limited requests were never processed
+                    continue
+                if e.status < 500:
+                    return dict()
+            except Exception as e:
+                logger.info("Instance creation failed: {} {}".format(name, e))
+            # The request may have created the instance anyway; only send it again if it did not
+            try:
+                existing = [d for d in api.list(refresh=True) if d.get('name') == name]
+            except Exception as e:
+                logger.info("Cannot check whether the instance exists, not creating it again: {} {}".format(name, e))
+                return dict()
+            if existing:
+                logger.info("Instance was created but its credentials were not returned, not creating it "
+                            "again: {} {}".format(existing[0].get('id'), name))
+                return dict()
+        return dict()
+
+    created = list()
+    failed = list()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(_create, name): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            data = future.result()
+            if not data:
+                logger.info("Giving up on instance: {}".format(name))
+                failed.append(name)
+                continue
+            instance_details = {k: v for k, v in data.items() if k in INSTANCE_FIELDS}
+            created.append(instance_details)
+            logger.info("Instance created: {} {}".format(instance_details.get('id'), name))
+            if on_result:
+                on_result(instance_details)
+    return created, failed
+
+
+class FleetWaiter:
+    """Waits for many instances at once, with one inventory call per tick.
+
+    The poll interval starts at `min_interval` and grows by `backoff` up to
+    `max_interval` while nothing changes; it drops back as soon as any instance
+    changes status. Statuses missing from the list are fetched by `workers` threads.
+    """
+
+    def __init__(self, api, min_interval=5, max_interval=60, backoff=1.5, time_out=900, workers=8):
+        self.api = api
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.time_out = time_out
+
+    def next_interval(self, interval, changed):
+        """Seconds to the next check: back to `min_interval` after a change, otherwise backing off."""
+        return self.min_interval if changed else min(interval * self.backoff, self.max_interval)
+
+    def poll(self, instance_ids):
+        wanted = set(instance_ids)
+        statuses = {d['id']: d.get('status') for d in self.api.list(refresh=True) if d.get('id') in wanted}
+        # The list endpoint does not always report status; look those up individually
+        missing = [instance_id for instance_id in wanted if not statuses.get(instance_id)]
+        for instance_id, status in map_concurrently(lambda i: self.api.status(i, refresh=True), missing,
+                                                    workers=self.workers):
+            # a failed lookup is None, not 'Unknown', which means the instance is gone
+            statuses[instance_id] = status
+        # one write of the cache for the whole sweep
+        self.api.inventory.flush()
+        return statuses
+
+    def iter_wait(self, instance_ids, status='running', time_out=None):
+        """Yield (instance_id, status) once per instance, as soon as it reaches `status`.
+
+        Instances still pending at the deadline are yielded with their last known status.
+        """
+        time_out = self.time_out if time_out is None else time_out
+        deadline = time.monotonic() + time_out
+        pending = list(dict.fromkeys(instance_ids))
+        last_seen = dict()
+        interval = self.min_interval
+        while pending:
+            try:
+                statuses = self.poll(pending)
+            except Exception as e:
+                # a failed sweep tells nothing about the instances; check again until the deadline
+                logger.info("Status check failed, retrying: {}".format(e))
+                statuses = dict(last_seen)
+            changed = False
+            for instance_id in list(pending):
+                current_status = statuses.get(instance_id)
+                if last_seen.get(instance_id) != current_status:
+                    changed = True
+                    last_seen[instance_id] = current_status
+                if current_status == status:
+                    pending.remove(instance_id)
+                    yield instance_id, current_status
+            if not pending:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            interval = self.next_interval(interval, changed)
+            logger.info("Waiting: {} instances for status {} (next check in {:.0f}s)".format(
+                len(pending), status, min(interval, remaining)))
+            time.sleep(min(interval, remaining))
+        for instance_id in pending:
+            yield instance_id, last_seen.get(instance_id)
+
+    def wait(self, instance_ids, status='running', time_out=None):
+        return dict(self.iter_wait(instance_ids, status=status, time_out=time_out))
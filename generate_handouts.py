@@ -1,8 +1,9 @@
+import os
 import time
 import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
-import pandas as pd
 from os import path
 
 from reportlab.lib.units import inch, cm
@@ -13,6 +14,8 @@ from reportlab.platypus import Paragraph
 
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+
+from records import read_records
 pdfmetrics.registerFont(TTFont('Vera', 'Vera.ttf'))
 pdfmetrics.registerFont(TTFont('VeraBd', 'VeraBd.ttf'))
 pdfmetrics.registerFont(TTFont('VeraIt', 'VeraIt.ttf'))
@@ -64,56 +67,63 @@ my_Style = ParagraphStyle('My Para style',
 def cli():
     parser = argparse.ArgumentParser()
     parser.add_argument('filename', type=str, help="filename of csv with readable passwords")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="render chunks of participants in parallel processes (requires pypdf to merge)")
     return parser.parse_args()
 
 
-def create_handouts(filename):
-    df = pd.read_csv(filename, dtype=object)
-    nameroot = path.splitext(filename)[0]
-    c = canvas.Canvas('handouts_' + nameroot + '.pdf', pagesize=letter)
+def draw_static_page(c):
+    """Everything that is the same on every handout, drawn once into a reusable form."""
+    c.beginForm('handout')
+    # Yes, this is janky/brittle to content changes in the positioning.
+    # If we use this more I will spend more time iterating/improving to make
+    # positions relative or error if things overlap / go off page.
+
+    # draw header, subheader and item 1 lines
+    c.setFont('VeraBd', 20)
+    c.drawCentredString(startx, starty, header)
+    c.setFont('VeraBd', 14)
+    c.drawCentredString(startx,starty-linedist, subheader)
+    c.setFont('Vera', 12)
+    c.drawString(1*inch, starty-linedist*3, line1)
+    c.drawString(1.2*inch, starty-linedist*4, line1a)
+
+    # item 2
+    c.drawString(1*inch, starty-linedist*8, line2)
+    c.drawString(1.2*inch, starty-linedist*10, line2a)
+    c.drawImage(qrcode, 6*inch,6*inch, width=100,height=100,mask=None)
+
+    # item 3
+    c.drawString(1*inch, starty-linedist*12, line3)
+    c.drawImage(colab, 2*inch,3.75*inch, width=300,height=86,mask=None)
+
+    # item 4
+    c.setFont('VeraBd', 14)
+    c.drawCentredString(startx, 3*inch, line4)
+    c.setFont('VeraIt', 12)
+
+    # resources paragraph
+    p2=Paragraph(paragraph2,my_Style)
+    p2.wrapOn(c,600,50)
+    p2.drawOn(c, 1.2*inch, inch + 60)
+    c.drawImage(logo, 3.25*inch,1*inch, width=150,height=53,mask=None)
+    c.endForm()
+
+
+def render_handouts(rows, output_file, first_page=1):
+    c = canvas.Canvas(output_file, pagesize=letter)
+    draw_static_page(c)
 
     # create one page per login
-    for ix, ival in df.iterrows():
-        """Yes, this is janky/brittle to content changes in the positioning.
-        If we use this more I will spend more time iterating/improving to make
-        positions relative or error if things overlap / go off page."""
-
-        # draw header, subheader and item 1 lines
-        c.setFont('VeraBd', 20)
-        c.drawCentredString(startx, starty, header)
-        c.setFont('VeraBd', 14)
-        c.drawCentredString(startx,starty-linedist, subheader)
-        c.setFont('Vera', 12)
-        c.drawString(1*inch, starty-linedist*3, line1)
-        c.drawString(1.2*inch, starty-linedist*4, line1a)
+    for page_num, ival in enumerate(rows, start=first_page):
+        c.doForm('handout')
 
         # connection details as indented paragraph block
         p1=Paragraph(paragraph1.format(ival['connection_url'], ival['newpassword']),my_Style)
         p1.wrapOn(c,600,50)
         p1.drawOn(c, 1.5*inch, starty-linedist*7)
 
-        # item 2
-        c.drawString(1*inch, starty-linedist*8, line2)
-        c.drawString(1.2*inch, starty-linedist*10, line2a)
-        c.drawImage(qrcode, 6*inch,6*inch, width=100,height=100,mask=None)
-
-        # item 3
-        c.drawString(1*inch, starty-linedist*12, line3)
-        c.drawImage(colab, 2*inch,3.75*inch, width=300,height=86,mask=None)
-
-        # item 4
-        c.setFont('VeraBd', 14)
-        c.drawCentredString(startx, 3*inch, line4)
-        c.setFont('VeraIt', 12)
-
-        # resources paragraph
-        p2=Paragraph(paragraph2,my_Style)
-        p2.wrapOn(c,600,50)
-        p2.drawOn(c, 1.2*inch, inch + 60)
-        c.drawImage(logo, 3.25*inch,1*inch, width=150,height=53,mask=None)
-
         # add page numbers
-        page_num = c.getPageNumber()
         c.setFont('Vera', 12)
         c.drawRightString(7.5*inch, 1*inch, str(page_num))
 
@@ -122,6 +132,47 @@ def create_handouts(filename):
 
     # save the file
     c.save()
+    return output_file
+
+
+def _render_chunk(args):
+    return render_handouts(*args)
+
+
+def create_handouts(filename, workers=1):
+    nameroot = path.splitext(filename)[0]
+    output_file = 'handouts_' + nameroot + '.pdf'
+
+    if workers > 1:
+        try:
+            from pypdf import PdfWriter
+        except ImportError:
+            logger.info("pypdf is not installed, rendering handouts in a single process")
+            workers = 1
+    if workers <= 1:
+        # stream rows straight from the csv into the pdf
+        return render_handouts(read_records(filename), output_file)
+
+    rows = [{k: row[k] for k in ['connection_url', 'newpassword']} for row in read_records(filename)]
+
+    # render contiguous chunks in parallel and merge them in page order
+    chunk_size = max(1, -(-len(rows) // workers))
+    chunks = [(rows[i:i + chunk_size], '{}.part{}.pdf'.format(output_file, i // chunk_size), i + 1)
+              for i in range(0, len(rows), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(_render_chunk, chunks))
+
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(part)
+    # each part embeds its own copy of the fonts, images and form
+    if hasattr(writer, 'compress_identical_objects'):
+        writer.compress_identical_objects()
+    with open(output_file, 'wb') as f:
+        writer.write(f)
+    for part in parts:
+        os.remove(part)
+    return output_file
 
 
 if __name__ == '__main__':
@@ -129,5 +180,5 @@ if __name__ == '__main__':
     filename = args.filename
 
     start = time.time()
-    create_handouts(filename)
+    create_handouts(filename, workers=args.workers)
     logger.info("Time to create handouts: {}s".format(time.time()-start))
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+
+class Inventory:
+    """Cached view of the tenant's instances, indexed by id, name and name prefix.
+
+    The instance list and per-instance details (from status calls) are kept with the
+    time they were fetched and served while younger than `ttl` seconds. Mutations
+    invalidate the affected entries. With `cache_file` set, the cache is also kept on
+    disk so back-to-back CLI runs can reuse it. The file is written when a new list
+    arrives; other changes are written by `flush`, which also runs at exit.
+    """
+
+    def __init__(self, ttl=30, cache_file=None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.listing = dict()
+        self.listed_at = 0.0
+        self.details = dict()
+        self.names = dict()
+        self.sorted_names = list()
+        self.dirty = False
+        self._load()
+        if self.cache_file:
+            atexit.register(self.flush)
+
+    def _fresh(self, fetched_at):
+        return bool(self.ttl) and time.time() - fetched_at < self.ttl
+
+    def _index(self):
+        self.names = {d.get('name'): instance_id for instance_id, d in self.listing.items() if d.get('name')}
+        self.sorted_names = sorted(self.names)
+
+    def list(self):
+        """Cached instance list, or None when it has to be fetched again."""
+        with self.lock:
+            if not self._fresh(self.listed_at):
+                return None
+            return [dict(d) for d in self.listing.values()]
+
+    def update(self, instance_list):
+        with self.lock:
+            self.listing = {d['id']: dict(d) for d in instance_list if d.get('id')}
+            self.listed_at = time.time()
+            self._index()
+            self._save()
+
+    def status(self, instance_id):
+        """Cached status, or None when it has to be fetched again."""
+        with self.lock:
+            details, fetched_at = self.details.get(instance_id, (None, 0.0))
+            if details and self._fresh(fetched_at):
+                return details.get('status')
+            if self._fresh(self.listed_at):
+                return self.listing.get(instance_id, {}).get('status')
+            return None
+
+    def update_details(self, instance_id, details):
+        with self.lock:
+            self.details[instance_id] = (dict(details), time.time())
+            self.dirty = True
+
+    def get(self, instance_id):
+        with self.lock:
+            details = dict(self.listing.get(instance_id, {}))
+            details.update(self.details.get(instance_id, ({}, 0.0))[0])
+            return details
+
+    def get_by_name(self, name):
+        with self.lock:
+            instance_id = self.names.get(name)
+        return self.get(instance_id) if instance_id else dict()
+
+    def with_prefix(self, prefix):
+        """Instances named `<prefix>_...`; `wkshp` does not take in `wkshp2_...`."""
+        prefix += '_'
+        with self.lock:
+            start = bisect.bisect_left(self.sorted_names, prefix)
+            matches = list()
+            for name in self.sorted_names[start:]:
+                if not name.startswith(prefix):
+                    break
+                matches.append(dict(self.listing[self.names[name]]))
+            return matches
+
+    def invalidate(self, instance_id=None):
+        """Forget one instance's status, or the whole inventory when no id is given."""
+        with self.lock:
+            if instance_id is None:
+                self.listed_at = 0.0
+                self.details.clear()
+            else:
+                self.details.pop(instance_id, None)
+                self.listing.get(instance_id, {}).pop('status', None)
+            self.dirty = True
+
+    def flush(self):
+        """Write changes made since the last write to `cache_file`."""
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+            self.listing = data.get('listing', {})
+            self.listed_at = data.get('listed_at', 0.0)
+            self.details = {k: tuple(v) for k, v in data.get('details', {}).items()}
+            self._index()
+        except (OSError, ValueError) as e:
+            logger.info("Ignoring unreadable inventory cache: {} {}".format(self.cache_file, e))
+
+    def _save(self):
+        self.dirty = False
+        if not self.cache_file:
+            return
+        data = {'listing': self.listing, 'listed_at': self.listed_at, 'details': self.details}
+        # a temp file of its own, since shards of one tenant share the cache file
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(self.cache_file) or '.',
+                                        prefix=os.path.basename(self.cache_file) + '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_file, self.cache_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
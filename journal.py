@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# Tasks that can be continued with --resume
+RESUMABLE_TASKS = ['create', 'clone']
+
+
+def journal_file(output_file):
+    return os.path.splitext(output_file)[0] + '_journal.jsonl'
+
+
+class Journal:
+    """Append-only log of the changes a run makes, one JSON object per line.
+
+    Every entry is flushed and fsynced before `record` returns, so the credentials of
+    an instance are on disk as soon as the API has returned them, even if the process
+    dies right after. Each run starts with a `start` entry; entries up to the next
+    `start` belong to that run. The file holds passwords and is readable by the
+    current user only.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.run = None
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.file = os.fdopen(fd, 'a')
+
+    def record(self, event, **fields):
+        entry = dict(fields, event=event, run=self.run, ts=time.time())
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def start(self, task, **fields):
+        self.run = uuid.uuid4().hex[:12]
+        self.record('start', task=task, **fields)
+        return self.run
+
+    def resume(self, run):
+        """Continue appending to `run`, a run returned by `last_run`."""
+        self.run = run['run']
+        self.record('resume')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_journal(filename):
+    entries = list()
+    if not os.path.exists(filename):
+        return entries
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # the last line is cut short if the process died while writing it
+                logger.info("Skipping unreadable journal line: {}".format(line[:80]))
+    return entries
+
+
+def last_run(filename, tasks=RESUMABLE_TASKS):
+    """State of the most recent run of one of `tasks` in the journal, or None.
+
+    Returns a dict with the run id and task, the planned instance `names`, `params` and
+    number of fan-out `seeds`, the instances `created` so far (by name), the ids of the
+    instances `overwritten` by a clone, the password rotations (by instance id) and
+    whether the run `finished`.
+    """
+    runs = dict()
+    latest = None
+    for entry in read_journal(filename):
+        event = entry.get('event')
+        if event == 'start':
+            if entry.get('task') not in tasks:
+                continue
+            latest = runs[entry['run']] = {'run': entry['run'], 'task': entry['task'], 'names': [], 'params': {},
+                                           'seeds': 0, 'created': {}, 'overwritten': [], 'rotations': {},
+                                           'finished': False}
+        state = runs.get(entry.get('run'))
+        if state is None:
+            continue
+        if event == 'plan':
+            state['names'] = entry.get('names', [])
+            state['params'] = entry.get('params', {})
+            state['seeds'] = entry.get('seeds', 0)
+        elif event == 'create':
+            state['created'][entry['name']] = entry.get('instance', {})
+        elif event == 'overwrite':
+            state['overwritten'].append(entry['instance_id'])
+        elif event in ['rotating', 'rotated']:
+            state['rotations'].setdefault(entry['instance_id'], {}).update(entry.get('row', {}))
+        elif event == 'finish':
+            state['finished'] = True
+        elif event == 'resume':
+            state['finished'] = False
+    return latest
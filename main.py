@@ -1,17 +1,48 @@
-import json
 import time
-import random
-import string
+_process_start = time.perf_counter()
+
+import os
+import sys
+import json
+import atexit
 import argparse
 import logging
 
-import pandas as pd
-
-from api import AuraAPI
+from fleet import FleetWaiter, provision, new_instance_names, INSTANCE_FIELDS
+from records import RecordWriter, print_records
+from metrics import Metrics
+from journal import Journal, journal_file, last_run
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level='INFO')
 
+ASYNC_TASKS = ['status', 'pause', 'resume', 'delete']
+# Tasks whose changes are recorded in the journal next to the output file
+JOURNALED_TASKS = ['create', 'clone', 'pause', 'resume', 'delete', 'reconcile', 'schedule']
+
+
+class StartupProfile:
+    """Wall-clock time between named points of a CLI run, printed with --profile-startup."""
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.marks = list()
+
+    def mark(self, label):
+        now = time.perf_counter()
+        self.marks.append((label, now - self.last))
+        self.last = now
+
+    def report(self):
+        print("Startup profile:")
+        for label, elapsed in self.marks:
+            print("  {:<28} {:8.1f} ms".format(label, elapsed * 1000))
+        print("  {:<28} {:8.1f} ms".format('total', (self.last - self.start) * 1000))
+
+
+profile = StartupProfile(_process_start)
+profile.mark('core imports')
 
 def cli():
     parser = argparse.ArgumentParser()
@@ -19,12 +50,30 @@ def cli():
     parser.add_argument('client_id',  type=str, help="Aura API Client ID")
     parser.add_argument('client_secret', type=str, help="Aura API Client Secret")
     parser.add_argument('task', type=str, help='setup task', choices=['create', 'clone', 'status', 'list', 'pause',
-                                                                      'resume', 'delete', 'snapshots'])
+                                                                      'resume', 'delete', 'snapshots', 'reconcile',
+                                                                      'watch', 'schedule'])
     parser.add_argument('--output', default='instances.csv', help="full path to csv file")
+    parser.add_argument('--rotate', action='store_true',
+                        help="create/clone: rotate to readable passwords as soon as each instance is running")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="run status/pause/resume/delete requests concurrently with asyncio (requires aiohttp)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="reconcile/schedule: print the plan without changing anything")
+    parser.add_argument('--resume', action='store_true',
+                        help="create/clone: continue the last interrupted run from its journal")
+    parser.add_argument('--shards', nargs='*', default=None, metavar='SHARD',
+                        help="run the task on all shards in config.json (or only the ones named) at once")
+    parser.add_argument('--profile-startup', action='store_true', help="print import and startup timings")
+    parser.add_argument('--metrics', default='', help="write request metrics and task timings as JSON to this file")
+    parser.add_argument('--prometheus', default='', help="write the metrics in Prometheus text format to this file")
     return parser.parse_args()
 
 def clone_instances(api, **kwargs):
 
+    # An interrupted run already picked its source snapshot
+    if kwargs.get('resume'):
+        return __clone_from_source(api, **kwargs)
+
     # Get configuration parameters
     params = kwargs.get('params', {})
 
@@ -32,74 +81,128 @@ def clone_instances(api, **kwargs):
     if source_instance_id:
         status = api.status(source_instance_id)
         if status not in ['running']:
-            logger.info("Source Instance is not running. Not ready to Clone: {} {}".format(instance_id, status))
+            logger.info("Source Instance is not running. Not ready to Clone: {} {}".format(source_instance_id, status))
             return list()
-        source_snapshot_date = params.get('source_snapshot_date', '')
-        source_snapshot_id =  __get_latest_snapshot(source_instance_id, source_snapshot_date)   
+        source_snapshot_id = params.get('source_snapshot_id', '')
+        if not source_snapshot_id:
+            source_snapshot_date = params.get('source_snapshot_date', '')
+            source_snapshot_id = __get_latest_snapshot(api, source_instance_id, source_snapshot_date,
+                                                       days=kwargs.get('snapshot_days', 1))
         kwargs['params'].update(
             {
             "source_snapshot_id":  source_snapshot_id
             }
         )
     if not source_instance_id:
-        logger.info("Source Instance ID not provided. Source Instance ID: {} {}".format(source_instance_id))
+        logger.info("Source Instance ID not provided. Source Instance ID: {}".format(source_instance_id))
         return list()
     
-    instances = create_instances(api, **kwargs)
+    instances = __clone_from_source(api, **kwargs)
+    return instances
+
+def __clone_from_source(api, **kwargs):
+    seeds = min(kwargs.get('fan_out', {}).get('seeds', 0), kwargs.get('num_instances', 0))
+    if kwargs.get('resume'):
+        seeds = kwargs['resume']['seeds']
+    if not seeds:
+        return create_instances(api, **kwargs)
+
+    # Tree fan-out: only the seeds are cloned from the snapshot; the other seats are
+    # created empty in the meantime and overwritten from the seeds in waves
+    from fanout import overwrite_in_waves
+    params = kwargs['resume']['params'] if kwargs.get('resume') else kwargs['params']
+    seat_params = {k: v for k, v in params.items() if not k.startswith('source_')}
+    instances = create_instances(api, seeds=seeds, seat_params=seat_params, **kwargs)
+
+    overwritten = set(kwargs['resume']['overwritten']) if kwargs.get('resume') else set()
+    sources = [d['id'] for d in instances if d.get('seed')] + [d['id'] for d in instances if d['id'] in overwritten]
+    targets = [d['id'] for d in instances if not d.get('seed') and d['id'] not in overwritten]
+    fan_out = kwargs.get('fan_out', {})
+    waves, _, failed = overwrite_in_waves(api, sources, targets, per_source=fan_out.get('per_source', 4),
+                                          max_wave=fan_out.get('max_wave', 50),
+                                          time_out=fan_out.get('time_out'))
+    for wave in waves:
+        logger.info("Wave {wave}: {cloned} of {targets} cloned from {sources} sources in {seconds}s".format(**wave))
+    if failed:
+        logger.info("Instances not cloned from a seed: {}".format(failed))
     return instances
 
-def create_instances(api, **kwargs):
+def create_instances(api, output_file=None, on_created=None, resume=None, seeds=0, seat_params=None, **kwargs):
     # Get the list of current instances
     current_instance_list = api.list()
     current_instance_names = [d['name'] for d in current_instance_list]
 
-    # Get configuration parameters
-    params = kwargs.get('params')
-
-    # New Instances
-    instances = list()
-    seqs = __random_sequences(kwargs.get('num_instances'))
-    for dbname_suffix in seqs:
-        db_name = '_'.join([kwargs.get('dbname_prefix'), dbname_suffix])
-        params.update({
-            "name": db_name
-        })
-
-        # Check if an instance exists with same name
-        if db_name in current_instance_names:
-            instance_details = [d for d in current_instance_list if d['name'] == db_name][0]
-            logger.info("Instance already exists: {}".format(instance_details))
-
-        # Create the new instance
-        data = api.create(params=params)
-        if not data:
-            continue
-        instance_details = {k: v for k, v in data.items() if
-                            k in ['id', 'connection_url', 'name', 'username', 'password']}
-        instances.append(instance_details)
-        time.sleep(5)
-    return instances
-
-def __random_sequences(num, length=7):
-    seqs = [''.join(random.choices(string.ascii_lowercase + string.digits, k=length)) for i in range(num)]
-    return seqs
-
-def __get_latest_snapshot(instance_id, snapshot_date=None):
-    snapshots = api.snapshots(instance_id, snapshot_date)
-    for snapshot in snapshots:
-        status = snapshot.get('status', '')
-        if status == 'Completed':
-            snapshot_id =  snapshot['snapshot_id']
-            break
-    return snapshot_id
-
-def collect_instance_ids(config):
+    if resume:
+        # Continue an interrupted run: same names and params, minus what was already created
+        params = resume['params']
+        previous = list(resume['created'].values())
+        remaining = [name for name in resume['names'] if name not in resume['created']]
+        lost = [name for name in remaining if name in current_instance_names]
+        if lost:
+            logger.info("Instances exist but their credentials were not recorded, not re-creating: {}".format(lost))
+        db_names = [name for name in remaining if name not in lost]
+        seed_names = resume['names'][:seeds]
+        logger.info("Resuming: {} instances already created, {} to go".format(len(previous), len(db_names)))
+    else:
+        # Get configuration parameters
+        params = kwargs.get('params')
+
+        # New Instance names, never reusing the name of an existing instance
+        db_names = new_instance_names(kwargs.get('dbname_prefix'), kwargs.get('num_instances'),
+                                      current_instance_names)
+        previous = list()
+        seed_names = db_names[:seeds]
+        api._record('plan', names=db_names, params=params, seeds=seeds)
+
+    # With seeds, only the seeds are created with `params`; the other seats with `seat_params`
+    params_by_name = {name: seat_params for name in db_names if name not in seed_names} if seeds else None
+
+    # Create the new instances concurrently, writing credentials as each one is accepted
+    with RecordWriter(output_file or os.devnull, INSTANCE_FIELDS) as writer:
+
+        def write_row(instance_details):
+            if seeds:
+                instance_details['seed'] = instance_details.get('name') in seed_names
+            writer.write(instance_details)
+            if on_created:
+                on_created(instance_details)
+
+        for instance_details in previous:
+            write_row(instance_details)
+
+        with api.metrics.span('provision'):
+            instances, failed = provision(api, db_names, params,
+                                          workers=kwargs.get('workers', 4),
+                                          rate_limit=kwargs.get('rate_limit', 1.0),
+                                          retries=kwargs.get('retries', 2),
+                                          on_result=write_row,
+                                          params_by_name=params_by_name)
+    if failed:
+        logger.info("Instances not created: {}".format(failed))
+    return previous + instances
+
+def snapshot_catalogue(api):
+    from snapshots import SnapshotCatalogue
+    snapshot_config = api.config.get('snapshots', {})
+    cache_file = snapshot_config.get('cache_file', '')
+    return SnapshotCatalogue(api, cache_file=cache_file.format(tenant_id=api.tenant_id) if cache_file else None,
+                             ttl=snapshot_config.get('ttl', 300), workers=snapshot_config.get('workers', 8))
+
+def __get_latest_snapshot(api, instance_id, snapshot_date=None, days=1):
+    from snapshots import date_range
+    snapshot = snapshot_catalogue(api).latest(instance_id, date_range(snapshot_date or None, days))
+    if not snapshot:
+        logger.info("No completed snapshot found: {} {}".format(instance_id, snapshot_date))
+        return ''
+    logger.info("Using snapshot {} taken at {}".format(snapshot['snapshot_id'], snapshot.get('timestamp')))
+    return snapshot['snapshot_id']
+
+def select_instance_ids(config, instance_list):
     prefix = config.get('dbname_prefix', '')
     _list = list()
     if prefix:
-        _instances = api.list()  # Get the list of current instances
-        _list = [d['id'] for d in _instances if d['name'].startswith(prefix)]
-    instance_ids = config.get('instance_ids') + _list
+        _list = [d['id'] for d in instance_list if d['name'].startswith(prefix + '_')]
+    instance_ids = config.get('instance_ids', []) + _list
 
     # Exclude instance IDs specified in the config list
     exclude_instances = config.get('exclude', [])
@@ -107,25 +210,106 @@ def collect_instance_ids(config):
         instance_ids = [ins for ins in instance_ids if ins not in exclude_instances]
     return instance_ids
 
-def pause_instances(api, **kwargs):
-
-    # Collect Instance IDs to pause
-    instance_ids = collect_instance_ids(kwargs)
-
-    # Check for instance status. Exclude the instances that are not running
-    running_instances = list()
-    for instance_id in instance_ids:
-        status = api.status(instance_id)
-        if status == 'running':
-            running_instances.append(instance_id)
+def collect_instance_ids(api, config):
+    prefix = config.get('dbname_prefix', '')
+    _instances = list()
+    if prefix:
+        _instances = api.find(prefix)  # Current instances with names that start with the prefix
+    return select_instance_ids(config, _instances)
 
-    paused_instances = list()
-    for instance_id in running_instances:
-        data = api.pause(instance_id)
-        if not data:
-            continue
-        paused_instances.append(data)
-    return paused_instances
+def pause_instances(api, **kwargs):
+    return __bulk(api, 'pause', **kwargs)
+
+
+def resume_instances(api, **kwargs):
+    return __bulk(api, 'resume', **kwargs)
+
+
+def delete_instances(api, **kwargs):
+    return __bulk(api, 'delete', **kwargs)
+
+
+def __bulk(api, operation, **kwargs):
+    from bulk import bulk_operation
+
+    # Collect Instance IDs; only the ones in a suitable status are changed
+    instance_ids = collect_instance_ids(api, kwargs)
+    return bulk_operation(api, operation, instance_ids,
+                          workers=kwargs.get('workers', 8),
+                          rate_limit=kwargs.get('rate_limit', 5.0),
+                          wait=kwargs.get('wait', False),
+                          time_out=kwargs.get('time_out'),
+                          progress=kwargs.get('progress', True))
+
+
+def instance_statuses(api, **kwargs):
+    instance_ids = collect_instance_ids(api, kwargs)
+    waiter = FleetWaiter(api, **dict(api.config.get('wait', {}), workers=kwargs.get('workers', 8)))
+    statuses = waiter.poll(instance_ids)
+    return [{"instance_id": instance_id, "status": statuses.get(instance_id) or 'failed'} for instance_id in instance_ids]
+
+
+def watch_instances(api, output_file, interval=5, lookups=20, target='running', slowest=5, probe=False,
+                    workers=8, connection_timeout=5, duration=0, stop_at_target=False, **kwargs):
+    from watch import FleetWatch
+
+    credentials = None
+    if probe:
+        # Probe with the credentials in the output file, rotated passwords included
+        from warmup import credentials as read_credentials
+        if os.path.exists(output_file):
+            credentials = list(read_credentials(output_file))
+        else:
+            logger.info("No credentials in {}, not probing".format(output_file))
+    watcher = FleetWatch(api, lambda instance_list: select_instance_ids(kwargs, instance_list), interval=interval,
+                         lookups=lookups, target=target, slowest=slowest, credentials=credentials, workers=workers,
+                         connection_timeout=connection_timeout)
+    return watcher.run(duration=duration, stop_at_target=stop_at_target)
+
+
+def schedule_instances(api, output_file, dry_run=False, duration=0, **kwargs):
+    from scheduler import PauseScheduler
+
+    credentials = None
+    if kwargs.get('idle_pause'):
+        # Probe with the credentials in the output file, rotated passwords included
+        from warmup import credentials as read_credentials
+        if os.path.exists(output_file):
+            credentials = list(read_credentials(output_file))
+    selection = {k: kwargs.pop(k) for k in ['instance_ids', 'dbname_prefix', 'exclude'] if k in kwargs}
+    scheduler = PauseScheduler(api, lambda instance_list: select_instance_ids(selection, instance_list),
+                               credentials=credentials, dry_run=dry_run, **kwargs)
+    scheduler.run(duration=duration)
+
+
+async def run_async_task(task, base_url, tenant_id, config, metrics=None, journal=None):
+    """Run the status/pause/resume/delete sweeps with all requests in flight at once."""
+    from api_async import AsyncAuraAPI
+    profile.mark('import api_async')
+
+    task_config = config[task]
+    async with AsyncAuraAPI(base_url, tenant_id, metrics=metrics, journal=journal, **config) as api:
+        _instances = list()
+        if task_config.get('dbname_prefix', ''):
+            _instances = await api.find(task_config['dbname_prefix'])
+        instance_ids = select_instance_ids(task_config, _instances)
+
+        # calls that failed are reported as 'failed' rows instead of ending the sweep
+        if task == 'status':
+            statuses = await api.status_many(instance_ids)
+            return [{"instance_id": instance_id, "status": status or 'failed'}
+                    for instance_id, status in statuses.items()]
+        if task == 'pause':
+            statuses = await api.status_many(instance_ids)
+            running_instances = [instance_id for instance_id, status in statuses.items() if status == 'running']
+            results = dict(zip(running_instances, await api.pause_many(running_instances)))
+            return [{"instance_id": instance_id, "status_before": statuses[instance_id] or 'failed',
+                     "result": ('accepted' if results[instance_id] else 'failed') if instance_id in results
+                     else 'skipped'} for instance_id in instance_ids]
+        calls = {'resume': api.resume_many, 'delete': api.delete_many}
+        results = await calls[task](instance_ids)
+        return [{"instance_id": instance_id, "result": 'accepted' if data else 'failed'}
+                for instance_id, data in zip(instance_ids, results)]
 
 
 def __resume_if_not_running(api, instance_id, wait=True):
@@ -141,72 +325,181 @@ def __resume_if_not_running(api, instance_id, wait=True):
         status = api.status(instance_id)
     return status
 
+def run_task(api, task, config, output_file, rotate=False, dry_run=False, resume=None):
+    """Run `task` with one client; returns the rows to print, or None when there are none."""
+    rotation = None
+    if rotate and task in ['create', 'clone']:
+        from pipeline import RotationPipeline
+        rotation = RotationPipeline(api, output_file, previous=resume['rotations'] if resume else None,
+                                    **config.get('rotate', {}))
+
+    if task == 'clone':
+        instances = clone_instances(api, output_file=output_file, resume=resume,
+                                    on_created=rotation.submit if rotation else None, **config['clone'])
+
+    if task == 'create':
+        instances = create_instances(api, output_file=output_file, resume=resume,
+                                     on_created=rotation.submit if rotation else None, **config['create'])
+
+    if rotation:
+        with api.metrics.span('rotate'):
+            rotated = rotation.close()
+        logger.info("Passwords updated: {} of {}".format(len([r for r in rotated if r['rotated'] == 'True']),
+                                                         len(rotated)))
+
+    if task == 'pause':
+        return pause_instances(api, **config['pause'])
+
+    if task == 'resume':
+        return resume_instances(api, **config['resume'])
+
+    if task == 'delete':
+        return delete_instances(api, **config['delete'])
+
+    if task == 'reconcile':
+        from reconcile import reconcile
+        return reconcile(api, output_file=output_file, dry_run=dry_run, **config['reconcile'])
+
+    if task == 'list':
+        return api.list()
+    
+    if task == 'snapshots':
+        from snapshots import date_range
+        instance_id = config['snapshots']['instance_id']
+        dates = date_range(config['snapshots'].get('snapshot_date') or None, config['snapshots'].get('days', 1))
+        snapshots = snapshot_catalogue(api).query(instance_id, dates, status=config['snapshots'].get('status'))
+        for snapshot in snapshots:
+            print(json.dumps(snapshot, indent=2))
+
+    if task == 'status':
+        return instance_statuses(api, **config['status'])
+
+    if task == 'watch':
+        return watch_instances(api, output_file, **config['watch'])
+
+    if task == 'schedule':
+        schedule_instances(api, output_file, dry_run=dry_run, **config['schedule'])
+
+
+def resume_state(task, output_file):
+    """State of the last run of `task` journaled next to `output_file`, or None if there is none.
+
+    A run that has finished has nothing to resume; its state has `finished` set.
+    """
+    state = last_run(journal_file(output_file))
+    if state is None or state['task'] != task:
+        logger.info("No {} run to resume in {}".format(task, journal_file(output_file)))
+        return None
+    if state['finished']:
+        logger.info("The last {} run has finished, nothing to resume".format(task))
+    return state
+
+
+def open_journal(task, output_file, resume=None):
+    """Journal next to `output_file` for a run of `task`, continuing `resume` if given."""
+    if task not in JOURNALED_TASKS:
+        return None
+    journal = Journal(journal_file(output_file))
+    if resume:
+        journal.resume(resume)
+    else:
+        journal.start(task)
+    return journal
+
+
+def export_metrics(metrics, json_file=None, prometheus_file=None):
+    summary = metrics.summary()
+    logger.info("{} API requests, {}s of API time in {}s".format(summary['requests'], summary['api_time_s'],
+                                                                 summary['wall_s']))
+    if json_file:
+        metrics.write_json(json_file)
+    if prometheus_file:
+        metrics.write_prometheus(prometheus_file)
+
+
 if __name__ == '__main__':
     start = time.time()
     args = cli()
     tenant_id = args.tenant_id
     output_file = args.output
+    if args.profile_startup:
+        atexit.register(profile.report)
+    metrics = Metrics()
+    if args.metrics or args.prometheus:
+        atexit.register(export_metrics, metrics, args.metrics, args.prometheus)
 
     with open("config.json", "r") as f:
         config = json.load(f)
     base_url = config.get('endpoint')
     config['auth']['client_id'] = args.client_id
     config['auth']['client_secret'] = args.client_secret
-
-    api = AuraAPI(base_url, tenant_id, **config)
-    _ = api.generate_token_if_expired()
-
-    if args.task == 'clone':
-        instances = clone_instances(api, **config['clone'])
-        df = pd.DataFrame(instances, index=None)
-        df.to_csv(output_file, index=False)
-
-    if args.task == 'create':
-        instances = create_instances(api, **config['create'])
-        df = pd.DataFrame(instances, index=None)
-        df.to_csv(output_file, index=False)
-
-    if args.task == 'pause':
-        instances = pause_instances(api, **config['pause'])
-        df = pd.DataFrame(instances, index=None)
-        print(df)
-
-    if args.task == 'resume':
-        instance_ids = collect_instance_ids(config['resume'])
-        resumed_instances = list()
-        for instance_id in instance_ids:
-            data = api.resume(instance_id, wait=False)
-            resumed_instances.append(data)
-        df = pd.DataFrame(resumed_instances, index=None)
-        print(df)
-
-    if args.task == 'delete':
-        instance_ids = collect_instance_ids(config['delete'])
-        deleted_instances = list()
-        for instance_id in instance_ids:
-            data = api.delete(instance_id)
-            deleted_instances.append(data)
-        df = pd.DataFrame(deleted_instances, index=None)
-        #df.to_csv(output_file, index=False)
-        print(df)
-
-    if args.task == 'list':
-        instances = api.list()
-        df = pd.DataFrame(instances, index=None)
-        print(df)
-    
-    if args.task == 'snapshots':
-        instance_id = config['snapshots']['instance_id']
-        snapshot_date = config['snapshots'].get('snapshot_date', '')
-        snapshots = api.snapshots(instance_id, snapshot_date=snapshot_date)
-        for snapshot in snapshots:
-            print(json.dumps(snapshot, indent=2))
-
-    if args.task == 'status':
-        instance_ids = collect_instance_ids(config['status'])
-        instance_status = list()
-        for instance_id in instance_ids:
-            status = api.status(instance_id)
-            instance_status.append({"instance_id": instance_id, "status":status})
-        df = pd.DataFrame(instance_status, index=None)
-        print(df)
+    profile.mark('parse args and config')
+
+    if args.shards is not None:
+        from api import AuraAPI
+        from shards import load_shards, run_sharded, SHARDED_TASKS
+        if args.task not in SHARDED_TASKS:
+            logger.info("The {} task cannot run sharded".format(args.task))
+            sys.exit(1)
+        shards = load_shards(config, args.shards, tenant_id=tenant_id)
+
+        def run_shard(shard, shard_config, shard_output):
+            resume = None
+            if args.resume:
+                resume = resume_state(args.task, shard_output)
+                if resume is None:
+                    raise ValueError("No {} run to resume".format(args.task))
+                if resume['finished']:
+                    return None
+            journal = open_journal(args.task, shard_output, resume)
+            api = AuraAPI(base_url, shard['tenant_id'], metrics=metrics, journal=journal, **shard_config)
+            with metrics.span('shard ' + shard['name']):
+                rows = run_task(api, args.task, shard_config, shard_output, rotate=args.rotate,
+                                dry_run=args.dry_run, resume=resume)
+            if journal:
+                journal.record('finish')
+                journal.close()
+            return rows
+
+        with metrics.span(args.task):
+            rows, failed = run_sharded(run_shard, shards, args.task, config, output_file)
+        profile.mark('task ' + args.task)
+        if rows is not None:
+            print_records(rows)
+        sys.exit(1 if failed else 0)
+
+    resume = None
+    if args.resume:
+        resume = resume_state(args.task, output_file)
+        if resume is None:
+            sys.exit(1)
+        if resume['finished']:
+            sys.exit(0)
+    journal = open_journal(args.task, output_file, resume)
+
+    if args.use_async and args.task in ASYNC_TASKS:
+        import asyncio
+        with metrics.span(args.task):
+            instances = asyncio.run(run_async_task(args.task, base_url, tenant_id, config, metrics=metrics,
+                                                   journal=journal))
+        if journal:
+            journal.record('finish')
+        profile.mark('task ' + args.task)
+        print_records(instances)
+        sys.exit(0)
+
+    # The access token is fetched by the first API call that needs one
+    from api import AuraAPI
+    profile.mark('import api')
+    api = AuraAPI(base_url, tenant_id, metrics=metrics, journal=journal, **config)
+
+    with metrics.span(args.task):
+        rows = run_task(api, args.task, config, output_file, rotate=args.rotate, dry_run=args.dry_run,
+                        resume=resume)
+    if journal:
+        journal.record('finish')
+        journal.close()
+
+    profile.mark('task ' + args.task)
+    if rows is not None:
+        print_records(rows)
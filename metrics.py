@@ -0,0 +1,178 @@
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# upper bounds (seconds) of the request latency histogram buckets
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+class OperationStats:
+    """Counters for one API operation (list, status, create, ...)."""
+
+    def __init__(self):
+        self.latencies = list()
+        self.buckets = [0] * len(BUCKETS)
+        self.statuses = dict()
+        self.retries = 0
+        self.rate_limited = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def observe(self, seconds, status, sent, received, retries, rate_limited):
+        self.latencies.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.retries += retries
+        self.rate_limited += rate_limited
+        self.bytes_sent += sent
+        self.bytes_received += received
+
+    def summary(self):
+        return {
+            'count': len(self.latencies),
+            'errors': sum(n for status, n in self.statuses.items() if not status or status >= 400),
+            'statuses': {str(status): n for status, n in sorted(self.statuses.items(), key=lambda s: str(s[0]))},
+            'total_s': round(sum(self.latencies), 3),
+            'p50_ms': round(percentile(self.latencies, 0.5) * 1000, 1),
+            'p90_ms': round(percentile(self.latencies, 0.9) * 1000, 1),
+            'p99_ms': round(percentile(self.latencies, 0.99) * 1000, 1),
+            'max_ms': round(max(self.latencies, default=0) * 1000, 1),
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+
+class Metrics:
+    """Request metrics of an API client and timed spans of the task that used it.
+
+    AuraAPI and AsyncAuraAPI call `observe` once per HTTP request (retries done by the
+    transport are counted on that request). Tasks wrap their phases in `span`; nested
+    spans are named after their parents, e.g. `create/provision`. The totals can be
+    written as a JSON summary or in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.operations = dict()
+            self.spans = list()
+
+    def observe(self, operation, seconds, status=None, sent=0, received=0, retries=0, rate_limited=0):
+        with self.lock:
+            stats = self.operations.setdefault(operation, OperationStats())
+            stats.observe(seconds, status, sent, received, retries, rate_limited)
+
+    @contextmanager
+    def span(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        path = '/'.join(stack)
+        start = time.perf_counter()
+        offset = time.time() - self.started
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                self.spans.append({'span': path, 'start_s': round(offset, 3), 'duration_s': round(elapsed, 3)})
+
+    def operation(self, name):
+        with self.lock:
+            stats = self.operations.get(name)
+            return stats.summary() if stats else OperationStats().summary()
+
+    def summary(self):
+        with self.lock:
+            operations = {name: stats.summary() for name, stats in sorted(self.operations.items())}
+            spans = list(self.spans)
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_s': round(time.time() - self.started, 3),
+            'requests': sum(op['count'] for op in operations.values()),
+            'api_time_s': round(sum(op['total_s'] for op in operations.values()), 3),
+            'operations': operations,
+            'spans': spans,
+        }
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        logger.info("Metrics written to {}".format(filename))
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = list()
+
+        def metric(name, kind, help_text):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        with self.lock:
+            operations = sorted(self.operations.items())
+            spans = list(self.spans)
+
+        metric('aura_api_request_duration_seconds', 'histogram', 'Latency of Aura API requests.')
+        for name, stats in operations:
+            for bound, count in zip(BUCKETS, stats.buckets):
+                lines.append('aura_api_request_duration_seconds_bucket{{operation="{}",le="{}"}} {}'.format(
+                    name, bound, count))
+            lines.append('aura_api_request_duration_seconds_bucket{{operation="{}",le="+Inf"}} {}'.format(
+                name, len(stats.latencies)))
+            lines.append('aura_api_request_duration_seconds_sum{{operation="{}"}} {}'.format(
+                name, sum(stats.latencies)))
+            lines.append('aura_api_request_duration_seconds_count{{operation="{}"}} {}'.format(
+                name, len(stats.latencies)))
+
+        metric('aura_api_responses_total', 'counter', 'Aura API responses by HTTP status.')
+        for name, stats in operations:
+            for status, count in sorted(stats.statuses.items(), key=lambda s: str(s[0])):
+                lines.append('aura_api_responses_total{{operation="{}",status="{}"}} {}'.format(
+                    name, status or 'error', count))
+
+        counters = [
+            ('aura_api_retries_total', 'retries', 'Aura API requests resent after a 429 or 5xx.'),
+            ('aura_api_rate_limited_total', 'rate_limited', 'Aura API responses with status 429.'),
+            ('aura_api_sent_bytes_total', 'bytes_sent', 'Request body bytes sent to the Aura API.'),
+            ('aura_api_received_bytes_total', 'bytes_received', 'Response body bytes received from the Aura API.'),
+        ]
+        for metric_name, attribute, help_text in counters:
+            metric(metric_name, 'counter', help_text)
+            for name, stats in operations:
+                lines.append('{}{{operation="{}"}} {}'.format(metric_name, name, getattr(stats, attribute)))
+
+        metric('aura_task_span_seconds', 'summary', 'Wall time of task phases.')
+        totals = dict()
+        for span in spans:
+            total, count = totals.get(span['span'], (0.0, 0))
+            totals[span['span']] = (total + span['duration_s'], count + 1)
+        for path, (total, count) in sorted(totals.items()):
+            lines.append('aura_task_span_seconds_sum{{span="{}"}} {}'.format(path, round(total, 3)))
+            lines.append('aura_task_span_seconds_count{{span="{}"}} {}'.format(path, count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.prometheus())
+        logger.info("Prometheus metrics written to {}".format(filename))
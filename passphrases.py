@@ -0,0 +1,91 @@
+import math
+import secrets
+import logging
+import threading
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+
+class WordList:
+    """Deduplicated, lower-cased words with their position in the list."""
+
+    def __init__(self, words):
+        index = dict()
+        for word in words:
+            word = word.strip().lower()
+            if word and word not in index:
+                index[word] = len(index)
+        self.index = index
+        self.words = tuple(index)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.index
+
+
+@lru_cache(maxsize=None)
+def load_word_list(filename):
+    """Word list from a text file with one word per line, loaded once per process.
+
+    Blank lines and lines starting with '#' are ignored. Diceware-style lines such as
+    `11111 abacus` use the last column, so the EFF lists can be used as they are.
+    """
+    with open(filename, 'r') as f:
+        words = [line.split()[-1] for line in f if line.strip() and not line.lstrip().startswith('#')]
+    word_list = WordList(words)
+    logger.info("Loaded {} words from {}".format(len(word_list), filename))
+    return word_list
+
+
+class PassphraseGenerator:
+    """Unique passphrases of `min_words` to `max_words` distinct words, drawn with `secrets`.
+
+    Every passphrase handed out by a generator is different from all the others it has
+    handed out (or been told about with `reserve`). The entropy of a passphrase is the
+    log2 of the number of equally likely choices that produced it: its length, then
+    its words in order.
+    """
+
+    def __init__(self, words, min_words=2, max_words=3, separator='-'):
+        self.words = words if isinstance(words, WordList) else WordList(words)
+        if not 1 <= min_words <= max_words <= len(self.words):
+            raise ValueError("Need 1 <= min_words <= max_words <= {} words, got {} and {}".format(
+                len(self.words), min_words, max_words))
+        self.min_words = min_words
+        self.max_words = max_words
+        self.separator = separator
+        self.random = secrets.SystemRandom()
+        self.issued = set()
+        self.lock = threading.Lock()
+
+    def entropy(self, num_words):
+        lengths = self.max_words - self.min_words + 1
+        return math.log2(lengths) + math.log2(math.perm(len(self.words), num_words))
+
+    def capacity(self):
+        return sum(math.perm(len(self.words), k) for k in range(self.min_words, self.max_words + 1))
+
+    def reserve(self, passphrases):
+        """Never hand out any of `passphrases`, e.g. the ones already in use."""
+        with self.lock:
+            self.issued.update(p for p in passphrases if p)
+
+    def generate(self, n=1):
+        """`n` new passphrases as (passphrase, entropy bits) tuples."""
+        with self.lock:
+            if len(self.issued) + n > self.capacity():
+                raise ValueError("Cannot make {} more unique passphrases from {} words; use a bigger word list "
+                                 "or more words per passphrase".format(n, len(self.words)))
+            passphrases = list()
+            while len(passphrases) < n:
+                num_words = self.min_words + secrets.randbelow(self.max_words - self.min_words + 1)
+                passphrase = self.separator.join(self.random.sample(self.words.words, num_words))
+                if passphrase in self.issued:
+                    continue
+                self.issued.add(passphrase)
+                passphrases.append((passphrase, round(self.entropy(num_words), 1)))
+            return passphrases
@@ -0,0 +1,137 @@
+import time
+import queue
+import logging
+import threading
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+
+from fleet import FleetWaiter, INSTANCE_FIELDS
+from records import RecordWriter
+from bolt import SocketLimit
+from readable_passwords import new_password, passphrase_generator, rotate_password, PASSWORD_FIELDS
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+
+class RotationPipeline:
+    """Rotates passwords of new instances while the rest of the fleet is still provisioning.
+
+    Instances handed to `submit` are polled together (one list() per tick) until they
+    are running, then their password is rotated on a worker pool and the row is
+    appended to the `_readable_pw` CSV next to `output_file`.
+
+    `previous` holds the rotations of an interrupted run by instance id, as read from
+    its journal: instances already rotated are written out without connecting to
+    them again, and the others reuse the password that was picked for them before.
+    """
+
+    def __init__(self, api, output_file, workers=8, time_out=900, previous=None, words='', min_words=2,
+                 max_words=3, max_sockets=None, connection_timeout=5):
+        self.api = api
+        self.sockets = SocketLimit(workers if max_sockets is None else max_sockets)
+        self.connection_timeout = connection_timeout
+        self.previous = previous or {}
+        self.generator = passphrase_generator(words, min_words, max_words)
+        self.generator.reserve(row.get('readablechunk') for row in self.previous.values())
+        self.waiter = FleetWaiter(api, **api.config.get('wait', {}))
+        self.time_out = time_out
+        self.incoming = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.futures = list()
+        self.results = list()
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+        readable_pw_file = path.splitext(output_file)[0] + '_readable_pw.csv'
+        self.writer = RecordWriter(readable_pw_file, INSTANCE_FIELDS + PASSWORD_FIELDS)
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+        self.thread.start()
+
+    def submit(self, instance_details):
+        row = self.previous.get(instance_details['id'], {})
+        if row.get('rotated') == 'True':
+            self._record(dict(instance_details, **row), None, journal=False)
+            return
+        self.incoming.put((instance_details, time.monotonic()))
+
+    def close(self):
+        """Wait until every submitted instance is rotated or timed out; returns the rows."""
+        self.closed.set()
+        self.thread.join()
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+        self.writer.close()
+        return self.results
+
+    def _watch(self):
+        pending = dict()
+        try:
+            self._watch_pending(pending)
+        except Exception as e:
+            # nothing else would rotate these instances, so they are recorded as failed
+            logger.error("Rotation stopped: {}".format(e))
+            while not self.incoming.empty():
+                instance_details, submitted = self.incoming.get()
+                pending[instance_details['id']] = (instance_details, submitted)
+            for instance_id, (instance_details, _) in pending.items():
+                self._record(dict(instance_details, **self._new_password(instance_id)),
+                             'rotation stopped: {}'.format(e))
+
+    def _watch_pending(self, pending):
+        interval = self.waiter.min_interval
+        error = ''
+        while not (self.closed.is_set() and self.incoming.empty() and not pending):
+            while not self.incoming.empty():
+                instance_details, submitted = self.incoming.get()
+                pending[instance_details['id']] = (instance_details, submitted)
+            if not pending:
+                time.sleep(0.5)
+                continue
+            try:
+                statuses = self.waiter.poll(list(pending))
+                error = ''
+            except Exception as e:
+                # e.g. a network or token error; keep waiting, the time out still applies
+                statuses = dict()
+                error = str(e)
+                logger.info("Status check failed, retrying: {}".format(error))
+            ready = [instance_id for instance_id in pending if statuses.get(instance_id) == 'running']
+            for instance_id in ready:
+                instance_details, _ = pending.pop(instance_id)
+                self.futures.append(self.executor.submit(self._rotate, instance_details))
+            for instance_id, (instance_details, submitted) in list(pending.items()):
+                if time.monotonic() - submitted > self.time_out:
+                    logger.info("Instance not running in time, skipping rotation: {}".format(instance_id))
+                    pending.pop(instance_id)
+                    self._record(dict(instance_details, **self._new_password(instance_id)),
+                                 'timed out ({})'.format(error) if error else 'timed out')
+            interval = self.waiter.next_interval(interval, bool(ready))
+            time.sleep(interval)
+
+    def _new_password(self, instance_id):
+        row = self.previous.get(instance_id, {})
+        if row.get('newpassword'):
+            return {k: row.get(k, '') for k in ['readablechunk', 'idchunk', 'newpassword', 'entropy_bits']}
+        return new_password(instance_id, self.generator)
+
+    def _rotate(self, instance_details):
+        row = dict(instance_details, **self._new_password(instance_details['id']))
+        # the new password is on disk before it is set, so a crash cannot lose it
+        self.api._record('rotating', instance_id=row['id'],
+                         row={k: row[k] for k in ['readablechunk', 'idchunk', 'newpassword', 'entropy_bits']})
+        error = rotate_password(row['connection_url'], row['password'], row['newpassword'],
+                                row.get('username') or 'neo4j', sockets=self.sockets,
+                                connection_timeout=self.connection_timeout)
+        self._record(row, error)
+
+    def _record(self, row, error, journal=True):
+        row['rotated'] = 'False' if error else 'True'
+        logger.info("{} {}: {}".format(row['id'], row.get('connection_url'), error or 'password updated'))
+        if journal:
+            self.api._record('rotated', instance_id=row['id'],
+                             row={k: row.get(k, '') for k in PASSWORD_FIELDS})
+        with self.lock:
+            self.writer.write(row)
+            self.results.append(row)
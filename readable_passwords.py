@@ -1,16 +1,18 @@
 import time
-import random
 import argparse
 import logging
-
-import pandas as pd
 from os import path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from graphdatascience import GraphDataScience
+from records import read_records, read_fieldnames, write_records, RecordWriter
+from passphrases import PassphraseGenerator, load_word_list
+from bolt import SocketLimit, open_driver, probe, verify_password
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level='INFO')
 
+PASSWORD_FIELDS = ['readablechunk', 'idchunk', 'newpassword', 'entropy_bits', 'rotated']
 
 word_list = [
     'apple', 'banana', 'orange', 'strawberry', 'grape', 'kiwi', 'pineapple', 'watermelon',
@@ -30,62 +32,187 @@ word_list = [
 def cli():
     parser = argparse.ArgumentParser()
     parser.add_argument('filename', type=str, help="filename of csv with passwords")
+    parser.add_argument('--workers', type=int, default=8, help="number of instances updated in parallel")
+    parser.add_argument('--max-sockets', type=int, default=None,
+                        help="most Bolt connections open at once (default: --workers)")
+    parser.add_argument('--connect-timeout', type=float, default=5, help="seconds before an instance counts as down")
+    parser.add_argument('--words', default='', help="word list file, one word per line (default: built-in list)")
+    parser.add_argument('--min-words', type=int, default=2, help="fewest words per passphrase")
+    parser.add_argument('--max-words', type=int, default=3, help="most words per passphrase")
     return parser.parse_args()
 
 
-def generate_passphrase(self, word_list=word_list, min_words=2, max_words=3, separator='-'):
-    num_words = random.randint(min_words, max_words)
-    passphrase = random.sample(list(word_list), num_words)
-    return separator.join(passphrase)
+def passphrase_generator(words='', min_words=2, max_words=3):
+    return PassphraseGenerator(load_word_list(words) if words else word_list, min_words, max_words)
+
+
+# shared by everything in this process, so passphrases are unique across a run
+default_generator = PassphraseGenerator(word_list)
 
 
 def get_id_chunk(x):
     return x[:3]
 
 
-def create_passwords(filename):
-    df = pd.read_csv(filename, dtype=object)
-    df['readablechunk'] = df.apply(generate_passphrase, axis=1)
-    df['idchunk'] = df['id'].apply(get_id_chunk)
-    df['newpassword'] = df['idchunk'] + '-' + df['readablechunk']
-    nameroot = path.splitext(filename)[0]
-    df.to_csv(nameroot + '_readable_pw.csv', index=False)
+def new_password(instance_id, generator=None, passphrase=None):
+    """Readable password columns for a single instance, as written by create_passwords."""
+    readablechunk, bits = passphrase or (generator or default_generator).generate(1)[0]
+    idchunk = get_id_chunk(instance_id)
+    return {'readablechunk': readablechunk, 'idchunk': idchunk, 'newpassword': idchunk + '-' + readablechunk,
+            'entropy_bits': bits}
 
 
-def update_passwords(filename):
+def create_passwords(filename, generator=None):
+    generator = generator or default_generator
     nameroot = path.splitext(filename)[0]
-    df = pd.read_csv(nameroot + '_readable_pw.csv', dtype=object)
-
-    error_log = []
-    f = open("errors.txt", "a")
+    readable_pw_file = nameroot + '_readable_pw.csv'
+
+    # Keep passwords generated by a previous run so a re-run does not orphan rotated instances
+    previous = dict()
+    if path.exists(readable_pw_file):
+        previous = {row['id']: row for row in read_records(readable_pw_file)}
+
+    # All new passphrases in one batch, none of them equal to one already handed out
+    generator.reserve(row.get('readablechunk') for row in previous.values())
+    needed = len([row for row in read_records(filename) if not previous.get(row['id'], {}).get('newpassword')])
+    passphrases = generator.generate(needed)
+    if passphrases:
+        bits = [b for _, b in passphrases]
+        logger.info("Generated {} unique passphrases with {}-{} bits of entropy each".format(
+            len(passphrases), min(bits), max(bits)))
+
+    fieldnames = read_fieldnames(filename)
+    fieldnames += [c for c in PASSWORD_FIELDS if c not in fieldnames]
+    passphrases = iter(passphrases)
+    with RecordWriter(readable_pw_file, fieldnames, replace=True) as writer:
+        for row in read_records(filename):
+            known = previous.get(row['id'], {})
+            if known.get('newpassword'):
+                row.update({k: v for k, v in known.items() if k not in row})
+            else:
+                row.update(new_password(row['id'], passphrase=next(passphrases)))
+            writer.write(row)
+
+
+def rotate_password(uri, password, new_password, username='neo4j', retries=3, retry_delay=10, sockets=None,
+                    connection_timeout=5):
+    """Change the password of one instance, reusing one Bolt driver for every attempt.
+
+    A `RETURN 1` probe runs first, so an instance that is down fails within
+    `connection_timeout` instead of the driver's default. Routing errors (the instance
+    is not fully up yet) are retried. `sockets`, a SocketLimit shared by the workers,
+    caps the connections open at once. Returns an empty string on success, or the
+    last error message.
+    """
+    from neo4j.exceptions import AuthError, ServiceUnavailable, SessionExpired
+
+    sockets = sockets or SocketLimit()
+    error = ''
+    try:
+        driver = open_driver(uri, (username, password), connection_timeout=connection_timeout)
+    except Exception as e:
+        # e.g. a malformed connection_url: this row fails, the others go on
+        return str(e)
+    with driver:
+        for attempt in range(retries + 1):
+            if attempt:
+                # a failed attempt leaves no connection open, so the socket slot is free while waiting
+                time.sleep(retry_delay * attempt)
+            try:
+                with sockets, driver.session(database='system') as session:
+                    probe(session)
+                    session.run('ALTER CURRENT USER SET PASSWORD FROM $password TO $new_password',
+                                password=password, new_password=new_password).consume()
+                return ''
+            except (ServiceUnavailable, SessionExpired) as e:
+                error = str(e)
+                logger.info("Instance not reachable yet, retrying: {} {}".format(uri, error))
+            except AuthError as e:
+                # The password may have been changed by an earlier run that did not record it
+                try:
+                    with sockets:
+                        if verify_password(driver, uri, (username, new_password), connection_timeout):
+                            return ''
+                except Exception:
+                    pass
+                return str(e)
+            except Exception as e:
+                return str(e)
+    return error
+
+
+def update_passwords(filename, workers=8, max_sockets=None, connection_timeout=5):
+    nameroot = path.splitext(filename)[0]
+    readable_pw_file = nameroot + '_readable_pw.csv'
+    fieldnames = read_fieldnames(readable_pw_file)
+    if 'rotated' not in fieldnames:
+        fieldnames.append('rotated')
 
     NEO4J_USERNAME = 'neo4j'
-    AURA_DS = True
-    for ix, irow in df.iterrows():
-        NEO4J_URI = irow['connection_url']
-        NEO4J_PASSWORD = irow['password']
-        NEW_PW = irow['newpassword']
-
-        try:
-            gds = GraphDataScience(
-                NEO4J_URI,
-                auth=(NEO4J_USERNAME, NEO4J_PASSWORD),
-                aura_ds=AURA_DS)
-
-            gds.set_database("system")
-
-            gds.run_cypher(f'''
-                        ALTER CURRENT USER SET PASSWORD FROM '{NEO4J_PASSWORD}' TO '{NEW_PW}';
-                       ''')
-        except:
-            f.write(str({'uri': NEO4J_URI, 'user': NEO4J_USERNAME,
-                         'pw': NEO4J_PASSWORD, 'newpw': NEW_PW}))
-            error_log.append({'uri': NEO4J_URI, 'user': NEO4J_USERNAME,
-                              'pw': NEO4J_PASSWORD, 'newpw': NEW_PW})
-    f.close()
-    errors = pd.DataFrame.from_dict(error_log)
-    if errors.shape[0]>0:
-        errors.to_csv(nameroot + '_errors.csv', index=False)
+    sockets = SocketLimit(workers if max_sockets is None else max_sockets)
+    error_log = []
+    counts = {'True': 0, 'False': 0, 'skipped': 0}
+
+    def finish(row, future):
+        if future is None:
+            counts['skipped'] += 1
+        else:
+            error = future.result()
+            row['rotated'] = 'False' if error else 'True'
+            counts[row['rotated']] += 1
+            logger.info("{} {}: {}".format(row['id'], row['connection_url'], error or 'password updated'))
+            if error:
+                error_log.append({'uri': row['connection_url'], 'user': NEO4J_USERNAME,
+                                  'pw': row['password'], 'newpw': row['newpassword'], 'error': error})
+        writer.write(row)
+
+    # Rows stream through a bounded window of in-flight updates and are written back in order
+    writer = RecordWriter(readable_pw_file, fieldnames, replace=True)
+    rows = read_records(readable_pw_file)
+    in_flight = deque()
+    current = None
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            try:
+                for current in rows:
+                    row, future = current, None
+                    if row.get('rotated') != 'True':
+                        future = executor.submit(rotate_password, row['connection_url'], row['password'],
+                                                 row['newpassword'], NEO4J_USERNAME, sockets=sockets,
+                                                 connection_timeout=connection_timeout)
+                    in_flight.append((row, future))
+                    current = None
+                    while in_flight and (len(in_flight) > 2 * workers or in_flight[0][1] is None
+                                         or in_flight[0][1].done()):
+                        finish(*in_flight.popleft())
+            except BaseException:
+                # interrupted: updates not started yet are dropped, the running ones finish below
+                for _, future in in_flight:
+                    if future is not None:
+                        future.cancel()
+                raise
+            finally:
+                while in_flight:
+                    row, future = in_flight.popleft()
+                    if future is None or not future.cancelled():
+                        finish(row, future)
+                    else:
+                        writer.write(row)
+    finally:
+        # Rows not reached are kept as they were, so the flags earned so far survive a Ctrl-C or crash
+        if current is not None:
+            writer.write(current)
+        for row in rows:
+            writer.write(row)
+        writer.close()
+
+    with open("errors.txt", "a") as f:
+        for error in error_log:
+            f.write(str(error))
+    if error_log:
+        write_records(nameroot + '_errors.csv', error_log, fieldnames=['uri', 'user', 'pw', 'newpw', 'error'])
+    logger.info("Passwords updated: {}, failed: {}, already rotated: {}".format(
+        counts['True'], counts['False'], counts['skipped']))
 
 
 if __name__ == '__main__':
@@ -93,9 +220,10 @@ if __name__ == '__main__':
     filename = args.filename
 
     pw_start = time.time()
-    create_passwords(filename)
+    create_passwords(filename, passphrase_generator(args.words, args.min_words, args.max_words))
     logger.info("Time to create passwords: {}s".format(time.time()-pw_start))
 
     update_start = time.time()
-    update_passwords(filename)
+    update_passwords(filename, workers=args.workers, max_sockets=args.max_sockets,
+                     connection_timeout=args.connect_timeout)
     logger.info("Time to update passwords: {}s".format(time.time()-update_start))
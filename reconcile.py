@@ -0,0 +1,119 @@
+import os
+import logging
+
+from fleet import map_concurrently, new_instance_names, provision, INSTANCE_FIELDS
+from records import RecordWriter
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# Statuses an instance passes through on its way to the target state; these are left alone
+TRANSITIONS = {
+    'running': ['creating', 'resuming', 'running', 'restoring', 'overwriting', 'updating'],
+    'paused': ['pausing', 'paused'],
+}
+# Parameters that can be compared against the details of an existing instance
+COMPARED_PARAMS = ['memory', 'region', 'type', 'cloud_provider']
+
+
+def plan(instances, dbname_prefix, num_instances, state='running', params=None, replace_mismatched=False,
+         existing_names=(), **kwargs):
+    """Minimal list of actions that brings the fleet with `dbname_prefix` to the desired state.
+
+    `instances` are the instance details of the current fleet, including their status;
+    `existing_names` are all instance names in the tenant, which new names must avoid.
+    An instance whose status is None (the lookup failed) counts as a seat but is never
+    deleted, paused or resumed, since it may be in use. Each action is a dict with the
+    action, instance id, name and the reason for it.
+    """
+    params = params or {}
+    fleet = sorted((d for d in instances if d.get('name', '').startswith(dbname_prefix + '_')),
+                   key=lambda d: d['name'])
+
+    def mismatches(instance):
+        return [k for k in COMPARED_PARAMS if k in params and k in instance and instance[k] != params[k]]
+
+    actions = list()
+    keep = list()
+    for instance in fleet:
+        if instance.get('status') in ['destroying', 'deleted']:
+            continue
+        diff = mismatches(instance)
+        if diff and replace_mismatched and instance.get('status') is not None:
+            actions.append({'action': 'delete', 'instance_id': instance['id'], 'name': instance['name'],
+                            'status': instance.get('status'), 'reason': 'mismatched ' + ','.join(diff)})
+            continue
+        if diff:
+            logger.info("Instance does not match params, keeping it: {} {}".format(instance['name'], diff))
+        keep.append(instance)
+
+    # Scale down: keep the instances that match the params and are already in (or moving to) the target state
+    if len(keep) > num_instances:
+        keep.sort(key=lambda d: (d.get('status') is not None, len(mismatches(d)),
+                                 d.get('status') not in TRANSITIONS.get(state, [state]), d['name']))
+        for instance in keep[num_instances:]:
+            if instance.get('status') is None:
+                continue
+            actions.append({'action': 'delete', 'instance_id': instance['id'], 'name': instance['name'],
+                            'status': instance.get('status'), 'reason': 'scale down'})
+        keep = keep[:num_instances] + [d for d in keep[num_instances:] if d.get('status') is None]
+
+    for instance in keep:
+        status = instance.get('status')
+        if status in TRANSITIONS.get(state, [state]):
+            continue
+        if status is None:
+            logger.info("Status could not be checked, leaving the instance alone: {}".format(instance['name']))
+            continue
+        if state == 'running' and status == 'paused':
+            action = 'resume'
+        elif state == 'paused' and status == 'running':
+            action = 'pause'
+        else:
+            logger.info("Instance cannot be moved to {} from its status: {} {}".format(state, instance['name'], status))
+            continue
+        actions.append({'action': action, 'instance_id': instance['id'], 'name': instance['name'],
+                        'status': status, 'reason': 'target state ' + state})
+
+    # Scale up with names that do not clash with any existing instance
+    names = new_instance_names(dbname_prefix, max(0, num_instances - len(keep)),
+                               set(existing_names) | {d['name'] for d in instances})
+    for name in names:
+        actions.append({'action': 'create', 'instance_id': '', 'name': name, 'status': '', 'reason': 'scale up'})
+    return actions
+
+
+def reconcile(api, output_file=None, dry_run=False, workers=8, rate_limit=1.0, **desired):
+    """Compute the plan for the desired fleet and, unless `dry_run`, execute it concurrently.
+
+    Credentials of newly created instances are added to the end of `output_file`, so
+    the rows of the seats already there are kept.
+    """
+    fleet = api.find(desired['dbname_prefix'])
+    statuses = dict(map_concurrently(api.status, [d['id'] for d in fleet], workers=workers))
+    unchecked = [d['name'] for d in fleet if statuses.get(d['id']) is None]
+    if unchecked:
+        logger.info("Status could not be checked, these instances are not changed: {}".format(unchecked))
+    instances = [dict(api.inventory.get(d['id']), status=statuses.get(d['id'])) for d in fleet]
+    actions = plan(instances, existing_names=[d['name'] for d in api.list()], **desired)
+    logger.info("Reconcile plan: {}".format({a: len([x for x in actions if x['action'] == a])
+                                             for a in ['create', 'delete', 'pause', 'resume']}))
+    if dry_run or not actions:
+        return actions
+
+    operations = {'delete': api.delete, 'pause': api.pause, 'resume': lambda i: api.resume(i, wait=False)}
+    changes = [a for a in actions if a['action'] in operations]
+    for action, data in map_concurrently(lambda a: operations[a['action']](a['instance_id']), changes,
+                                         workers=workers, rate_limit=rate_limit):
+        action['result'] = 'ok' if data else 'failed'
+
+    creates = {a['name']: a for a in actions if a['action'] == 'create'}
+    if creates:
+        with RecordWriter(output_file or os.devnull, INSTANCE_FIELDS, append=True) as writer:
+            created, failed = provision(api, list(creates), desired.get('params', {}), workers=workers,
+                                        rate_limit=rate_limit, on_result=writer.write)
+        for instance_details in created:
+            creates[instance_details['name']].update(instance_id=instance_details['id'], result='ok')
+        for name in failed:
+            creates[name]['result'] = 'failed'
+    return actions
@@ -0,0 +1,80 @@
+import os
+import csv
+import sys
+
+
+def read_records(filename):
+    """Yield each row of a CSV file as a dict, one row at a time."""
+    with open(filename, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            yield row
+
+
+def read_fieldnames(filename):
+    with open(filename, 'r', newline='') as f:
+        return next(csv.reader(f), [])
+
+
+class RecordWriter:
+    """Writes dict rows to a CSV file, flushing after every row so partial runs are kept.
+
+    With `replace=True` the rows go to a temporary file that replaces `filename` on a
+    clean close, so a file can be rewritten while it is being read. If the block
+    raises, the original file is left untouched. With `append=True` the rows are added
+    to the end of an existing file, in the columns of its header.
+    """
+
+    def __init__(self, filename, fieldnames, replace=False, append=False):
+        self.filename = filename
+        self.path = filename + '.tmp' if replace else filename
+        header = append and not replace and os.path.isfile(filename) and read_fieldnames(filename)
+        self.file = open(self.path, 'a' if header else 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=header or fieldnames, extrasaction='ignore')
+        if not header:
+            self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def close(self, commit=True):
+        self.file.close()
+        if self.path == self.filename:
+            return
+        if commit:
+            os.replace(self.path, self.filename)
+        else:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(commit=exc_type is None)
+
+
+def write_records(filename, records, fieldnames):
+    with RecordWriter(filename, fieldnames) as writer:
+        for row in records:
+            writer.write(row)
+
+
+def print_records(records):
+    """Print rows as a table.
+
+    pandas is used for display only when something else already imported it; importing
+    it just to print a few rows would dominate the run time of quick commands.
+    """
+    records = list(records)
+    pd = sys.modules.get('pandas')
+    if pd is not None:
+        print(pd.DataFrame(records, index=None))
+        return
+    if not records:
+        print("Empty")
+        return
+    columns = list(dict.fromkeys(k for row in records for k in row))
+    table = [columns] + [[str(row.get(c, '')) for c in columns] for row in records]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    for line in table:
+        print('  '.join(value.ljust(width) for value, width in zip(line, widths)))
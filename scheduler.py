@@ -0,0 +1,259 @@
+import time
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from fleet import FleetWaiter
+from bolt import SocketLimit, open_driver
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# Field ranges of a cron expression: minute hour day-of-month month day-of-week
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+def parse_cron_field(field, low, high):
+    """Values allowed by one cron field: `*`, `5`, `1-5`, `*/15`, `0-30/10` or lists of them."""
+    values = set()
+    for part in field.split(','):
+        spec, _, step = part.partition('/')
+        if spec == '*':
+            start, end = low, high
+        elif '-' in spec:
+            start, end = (int(v) for v in spec.split('-'))
+        else:
+            # as in cron, `5/10` starts at 5 and runs to the end of the range
+            start = int(spec)
+            end = high if step else start
+        if not low <= start <= end <= high:
+            raise ValueError("Cron field {} out of range {}-{}".format(part, low, high))
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+class CronSchedule:
+    """A five-field cron expression (minute hour day-of-month month day-of-week), in local time.
+
+    As in cron, an instant matches when either day field matches if both are
+    restricted, and 0 and 7 are both Sunday.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Expected 5 fields in cron expression: {}".format(expression))
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS))
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def day_matches(self, dt):
+        if dt.month not in self.months:
+            return False
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, dt):
+        """The first matching minute after `dt`."""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 4)
+        while dt < limit:
+            if not self.day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError("Cron expression never matches: {}".format(self.expression))
+
+
+class ScheduledEvent:
+    """A bulk operation that runs `lead` seconds before each time matching `cron`."""
+
+    def __init__(self, operation, cron, lead=0):
+        self.operation = operation
+        self.schedule = CronSchedule(cron)
+        self.lead = lead
+        self.occurrence = self.schedule.next_after(datetime.now())
+        self.waiting = False
+
+    def due(self, now):
+        return now >= self.occurrence - timedelta(seconds=self.lead)
+
+    def advance(self, now):
+        """Move on to the next occurrence after `now`; returns the one that was due."""
+        occurrence = self.occurrence
+        self.occurrence = self.schedule.next_after(max(occurrence, now))
+        self.waiting = False
+        return occurrence
+
+
+def transaction_counter(uri, auth, database='neo4j', connection_timeout=5.0, sockets=None):
+    """Highest transaction number of `database`, a cheap activity counter; None if unreachable.
+
+    Every query, from any client, takes the next number, so comparing two readings
+    shows whether the instance was used in between.
+    """
+    try:
+        with sockets or SocketLimit(), open_driver(uri, auth, connection_timeout=connection_timeout) as driver, \
+                driver.session(database=database) as session:
+            ids = [record['transactionId'] for record in
+                   session.run('SHOW TRANSACTIONS YIELD transactionId, database '
+                               'WHERE database = $database RETURN transactionId', database=database)]
+        return max(int(transaction_id.rsplit('-', 1)[-1]) for transaction_id in ids)
+    except Exception as e:
+        logger.debug("Activity probe failed: {} {}".format(uri, e))
+        return None
+
+
+class PauseScheduler:
+    """Pauses and resumes a fleet on a schedule, and pauses instances that sit idle.
+
+    Everything is done for the whole fleet at once: `pause_at` and `resume_at` (cron
+    expressions; resumes start `resume_lead` seconds ahead of each session) run one
+    bulk operation each, the status of the fleet is refreshed every `status_interval`
+    seconds, and each tick probes at most `batch_size` running instances whose last
+    probe is `probe_interval` seconds old. A running instance with no transactions but
+    the probes' own (up to `idle_transactions` more are tolerated) for `idle_pause`
+    seconds is paused; 0 turns idle detection off. Probes need `credentials`.
+    """
+
+    def __init__(self, api, select, credentials=None, pause_at=(), resume_at=(), resume_lead=900, idle_pause=0,
+                 idle_transactions=0, probe_interval=300, status_interval=600, tick=60, batch_size=200,
+                 database='neo4j', workers=8, rate_limit=5.0, connection_timeout=5, dry_run=False):
+        self.api = api
+        self.select = select
+        self.credentials = {row['id']: row for row in credentials or []}
+        self.events = [ScheduledEvent('pause', cron) for cron in pause_at]
+        self.events += [ScheduledEvent('resume', cron, lead=resume_lead) for cron in resume_at]
+        self.idle_pause = idle_pause
+        self.idle_transactions = idle_transactions
+        self.probe_interval = probe_interval
+        self.status_interval = status_interval
+        self.tick = tick
+        self.batch_size = batch_size
+        self.database = database
+        self.workers = workers
+        self.rate_limit = rate_limit
+        self.connection_timeout = connection_timeout
+        self.dry_run = dry_run
+        self.sockets = SocketLimit(workers)
+        self.waiter = FleetWaiter(api, **dict(api.config.get('wait', {}), workers=workers))
+        self.running = set()
+        self.activity = dict()
+        self.hold_until = 0.0
+        self.statuses_at = 0.0
+        if self.idle_pause and not self.credentials:
+            logger.info("No credentials to probe with, idle instances will not be paused")
+
+    def instance_ids(self):
+        return self.select(self.api.list())
+
+    def refresh_statuses(self, instance_ids):
+        statuses = self.waiter.poll(instance_ids)
+        self.running = {i for i in instance_ids if statuses.get(i) == 'running'}
+        self.statuses_at = time.time()
+        for instance_id in set(self.activity) - self.running:
+            del self.activity[instance_id]
+        logger.info("{} of {} instances running".format(len(self.running), len(instance_ids)))
+
+    def bulk(self, operation, instance_ids, reason):
+        if not instance_ids:
+            return []
+        if self.dry_run:
+            logger.info("Would {} {} instances ({}): {}".format(operation, len(instance_ids), reason,
+                                                                instance_ids))
+            rows = [{'instance_id': instance_id, 'result': 'accepted'} for instance_id in instance_ids]
+        else:
+            from bulk import bulk_operation
+            logger.info("{} {} instances ({})".format(operation, len(instance_ids), reason))
+            rows = bulk_operation(self.api, operation, instance_ids, workers=self.workers,
+                                  rate_limit=self.rate_limit, progress=False)
+        accepted = [row['instance_id'] for row in rows if row['result'] == 'accepted']
+        if operation == 'pause':
+            self.running -= set(accepted)
+            for instance_id in accepted:
+                self.activity.pop(instance_id, None)
+        return rows
+
+    def run_events(self, instance_ids):
+        """Run the events that are due. An event is only moved on once its bulk operation ran
+        against a non-empty listing; otherwise it is tried again next tick."""
+        now = datetime.now()
+        for event in self.events:
+            if not event.due(now):
+                continue
+            if not instance_ids:
+                if not event.waiting:
+                    logger.info("No instances to {}, trying again every tick".format(event.operation))
+                    event.waiting = True
+                continue
+            reason = 'scheduled {} at {:%Y-%m-%d %H:%M}'.format(event.schedule.expression, event.occurrence)
+            self.bulk(event.operation, instance_ids, reason)
+            occurrence = event.advance(now)
+            if event.operation == 'resume':
+                # instances are not idle before the session starts
+                self.hold_until = max(self.hold_until, occurrence.timestamp())
+                self.statuses_at = 0.0
+
+    def probe_batch(self):
+        """Probe the running instances due for a probe; returns the ones idle for `idle_pause`."""
+        now = time.time()
+        due = [i for i in self.running if i in self.credentials
+               and now - self.activity.get(i, {}).get('probed', 0) >= self.probe_interval]
+        due.sort(key=lambda i: self.activity.get(i, {}).get('probed', 0))
+        batch = due[:self.batch_size]
+
+        def _probe(instance_id):
+            row = self.credentials[instance_id]
+            return transaction_counter(row['connection_url'], (row.get('username') or 'neo4j', row['password']),
+                                       database=self.database, connection_timeout=self.connection_timeout,
+                                       sockets=self.sockets)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            for instance_id, counter in zip(batch, executor.map(_probe, batch)):
+                state = self.activity.setdefault(instance_id, {'counter': None, 'active': now})
+                state['probed'] = now
+                if counter is None:
+                    continue
+                # each probe is one transaction of its own
+                if state['counter'] is not None and counter - state['counter'] > 1 + self.idle_transactions:
+                    state['active'] = now
+                state['counter'] = counter
+
+        return [i for i, state in self.activity.items() if i in self.running
+                and now - max(state['active'], self.hold_until) >= self.idle_pause]
+
+    def run(self, duration=0):
+        """Run until Ctrl-C or for `duration` seconds (0: no limit)."""
+        for event in self.events:
+            logger.info("Next {}: {:%Y-%m-%d %H:%M} ({})".format(event.operation, event.occurrence,
+                                                                  event.schedule.expression))
+        deadline = time.monotonic() + duration if duration else None
+        try:
+            while True:
+                tick = time.monotonic()
+                try:
+                    instance_ids = self.instance_ids()
+                    self.run_events(instance_ids)
+                    if self.idle_pause and self.credentials:
+                        if time.time() - self.statuses_at >= self.status_interval:
+                            self.refresh_statuses(instance_ids)
+                        idle = self.probe_batch()
+                        self.bulk('pause', idle, 'idle for {}s'.format(self.idle_pause))
+                except Exception as e:
+                    # e.g. the API is down for a while; due events stay due for the next tick
+                    logger.error("Scheduler tick failed, trying again in {}s: {}".format(self.tick, e))
+                if deadline and time.monotonic() >= deadline:
+                    break
+                time.sleep(max(0.0, self.tick - (time.monotonic() - tick)))
+        except KeyboardInterrupt:
+            pass
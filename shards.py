@@ -0,0 +1,161 @@
+import os
+import copy
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from records import RecordWriter, read_records, read_fieldnames
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# Tasks that split `num_instances` between the shards; the others run in full on every shard
+SPLIT_TASKS = ['create', 'clone', 'reconcile']
+SHARDED_TASKS = SPLIT_TASKS + ['status', 'list', 'pause', 'resume', 'delete']
+# Keys of a shard that describe the shard itself; all other keys override the task's config
+SHARD_KEYS = ['name', 'tenant_id', 'client_id', 'client_secret', 'weight']
+
+
+def load_shards(config, names=None, tenant_id=''):
+    """The shards in `config['shards']`, or only the ones in `names` if given.
+
+    A shard without a tenant_id uses `tenant_id`. Shards of one tenant see each other's
+    instances, so they need their own `dbname_prefix`; none may start with another plus '_'.
+    """
+    shards = [dict(shard, tenant_id=shard.get('tenant_id') or tenant_id) for shard in config.get('shards', [])]
+    if names:
+        unknown = set(names) - {shard['name'] for shard in shards}
+        if unknown:
+            raise ValueError("Unknown shards: {}".format(sorted(unknown)))
+        shards = [shard for shard in shards if shard['name'] in names]
+    if not shards:
+        raise ValueError("No shards configured")
+    if len({shard['name'] for shard in shards}) < len(shards):
+        raise ValueError("Shard names must be unique")
+
+    for shard in shards:
+        for other in shards:
+            if shard is other or shard['tenant_id'] != other['tenant_id']:
+                continue
+            prefix, other_prefix = shard.get('dbname_prefix', ''), other.get('dbname_prefix', '')
+            if not prefix or not other_prefix or (other_prefix + '_').startswith(prefix + '_'):
+                raise ValueError("Shards {} and {} share tenant {} and need dbname_prefixes that do not "
+                                 "overlap".format(shard['name'], other['name'], shard['tenant_id']))
+    return shards
+
+
+def split_by_weight(total, weights):
+    """Split `total` into integer parts proportional to `weights` (largest remainder first)."""
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        raise ValueError("Shard weights must add up to more than 0")
+    exact = [total * weight / weight_sum for weight in weights]
+    parts = [int(share) for share in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda i: exact[i] - parts[i], reverse=True)
+    for i in by_remainder[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+def shard_config(config, shard, task, num_instances=None):
+    """Copy of `config` for one shard: its credentials, and its overrides in the task's section."""
+    config = copy.deepcopy(config)
+    config.pop('shards', None)
+    for key in ['client_id', 'client_secret']:
+        if shard.get(key):
+            config['auth'][key] = shard[key]
+            # a token of the default client is no use to another one
+            config['auth']['access_token'] = ''
+
+    if task not in config:
+        # e.g. list, which has no settings to override
+        return config
+    section = config[task]
+    for key, value in shard.items():
+        if key in SHARD_KEYS:
+            continue
+        if key == 'params':
+            section.setdefault('params', {}).update(value)
+        else:
+            section[key] = value
+    if num_instances is not None:
+        section['num_instances'] = num_instances
+    return config
+
+
+def shard_file(filename, shard):
+    root, ext = os.path.splitext(filename)
+    return '{}_{}{}'.format(root, shard['name'], ext)
+
+
+def merge_files(filename, parts):
+    """Concatenate the CSV files in `parts`, (shard, filename) pairs, into `filename` with a `shard` column."""
+    parts = [(shard, part) for shard, part in parts if os.path.exists(part)]
+    if not parts:
+        return 0
+    fieldnames = list()
+    for _, part in parts:
+        fieldnames += [name for name in read_fieldnames(part) if name not in fieldnames]
+    count = 0
+    with RecordWriter(filename, fieldnames + ['shard'], replace=True) as writer:
+        for shard, part in parts:
+            for row in read_records(part):
+                writer.write(dict(row, shard=shard['name']))
+                count += 1
+    logger.info("Merged {} rows from {} shards into {}".format(count, len(parts), filename))
+    return count
+
+
+def run_sharded(run, shards, task, config, output_file):
+    """Run `task` on every shard at once and merge the results.
+
+    `run(shard, config, output_file)` runs the task with the shard's own client and
+    returns its rows. Each shard gets its own copy of `config` and writes to its own
+    output file (and journal); create/clone/reconcile split `num_instances` between
+    the shards by weight. The per-shard files of this run are merged into `output_file`
+    (files left by earlier runs of inactive or failed shards are not). Returns
+    the rows of all shards, each tagged with its shard (None if there are none), and
+    the names of the shards that failed.
+    """
+    counts = [None] * len(shards)
+    if task in SPLIT_TASKS:
+        counts = split_by_weight(config[task]['num_instances'], [shard.get('weight', 1) for shard in shards])
+        logger.info("{} instances by shard: {}".format(
+            task, ', '.join('{} {}'.format(shard['name'], n) for shard, n in zip(shards, counts))))
+
+    def _run(shard, num_instances):
+        shard_cfg = shard_config(config, shard, task, num_instances)
+        if task in ['pause', 'resume', 'delete'] and len(shards) > 1:
+            # progress tables of concurrent shards would draw over each other
+            shard_cfg[task].setdefault('progress', False)
+        return run(shard, shard_cfg, shard_file(output_file, shard))
+
+    # a shard with no instances to create has nothing to do (reconcile may still delete)
+    active = [(shard, n) for shard, n in zip(shards, counts) if n != 0 or task == 'reconcile']
+    rows = list()
+    failed = list()
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=len(active) or 1) as executor:
+        futures = [(shard, executor.submit(_run, shard, n)) for shard, n in active]
+        for shard, future in futures:
+            try:
+                shard_rows = future.result()
+            except Exception as e:
+                logger.error("Shard {} failed: {}".format(shard['name'], e))
+                failed.append(shard['name'])
+                continue
+            if shard_rows is not None:
+                rows += [dict(row, shard=shard['name']) for row in shard_rows]
+
+    if task in SPLIT_TASKS:
+        # a shard that failed before it wrote anything may still have the file of an earlier run
+        ran = [shard for shard, _ in active if shard['name'] not in failed
+               or os.path.exists(shard_file(output_file, shard))
+               and os.path.getmtime(shard_file(output_file, shard)) >= started]
+        merge_files(output_file, [(shard, shard_file(output_file, shard)) for shard in ran])
+        readable_pw_file = os.path.splitext(output_file)[0] + '_readable_pw.csv'
+        merge_files(readable_pw_file, [(shard, os.path.splitext(shard_file(output_file, shard))[0] + '_readable_pw.csv')
+                                       for shard in ran])
+    if failed:
+        logger.error("Shards failed: {}".format(failed))
+    return (rows if task not in ['create', 'clone'] else None), failed
@@ -0,0 +1,266 @@
+import re
+import json
+import time
+import random
+import string
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# status while a change is in progress -> status once it completes
+TRANSITIONS = {
+    'creating': 'running',
+    'overwriting': 'running',
+    'resuming': 'running',
+    'pausing': 'paused',
+    'destroying': None,
+}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Aura v1 API")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help="mean seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.2, help="latency jitter as a fraction of --latency")
+    parser.add_argument('--transition-delay', type=float, default=5.0,
+                        help="seconds an instance spends creating/pausing/resuming/...")
+    parser.add_argument('--rate-limit', type=float, default=0, help="requests per second before answering 429")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests answered with a 500")
+    parser.add_argument('--list-status', action='store_true', help="include status in the instance list")
+    return parser.parse_args()
+
+
+class AuraSimulator:
+    """In-memory Aura tenant served over HTTP.
+
+    Instances move through the same statuses as on Aura, each change taking
+    `transition_delay` seconds. Responses are delayed by `latency` (+/- `jitter`),
+    requests above `rate_limit` per second get a 429 with Retry-After, and a random
+    `error_rate` fraction fail with a 500.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, jitter=0.2, transition_delay=5.0, rate_limit=0,
+                 error_rate=0, list_status=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.transition_delay = transition_delay
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.list_status = list_status
+        self.lock = threading.Lock()
+        self.instances = dict()
+        self.snapshots = dict()
+        self.requests = dict()
+        self.responses = dict()
+        self.window = (0, 0)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request_count(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def error_count(self):
+        with self.lock:
+            return sum(n for status, n in self.responses.items() if status >= 400)
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests.clear()
+            self.responses.clear()
+
+    def record_response(self, status):
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+
+    def add_instance(self, name, status='running', **details):
+        """Seed an instance directly, without going through the API."""
+        with self.lock:
+            return dict(self._new_instance(name, status, **details))
+
+    # state -----------------------------------------------------------------
+
+    def _new_instance(self, name, status, **details):
+        instance_id = ''.join(random.choices('0123456789abcdef', k=8))
+        instance = dict(details, id=instance_id, name=name, tenant_id=details.get('tenant_id', ''),
+                        connection_url='neo4j+s://{}.databases.neo4j.io'.format(instance_id),
+                        username='neo4j', password=''.join(random.choices(string.ascii_letters, k=20)),
+                        status=status, ready_at=time.monotonic() + self.transition_delay)
+        self.instances[instance_id] = instance
+        # a scheduled snapshot every 6 hours for the last 3 days; the newest one is still in progress
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        taken = [now - timedelta(hours=6 * i) for i in reversed(range(12))]
+        self.snapshots[instance_id] = [{'snapshot_id': '{}-{}'.format(instance_id, i), 'instance_id': instance_id,
+                                        'status': 'InProgress' if i == len(taken) - 1 else 'Completed',
+                                        'timestamp': t.strftime('%Y-%m-%dT%H:%M:%SZ'), 'profile': 'Scheduled'}
+                                       for i, t in enumerate(taken)]
+        return instance
+
+    def _current(self, instance_id):
+        instance = self.instances.get(instance_id)
+        if instance and instance['status'] in TRANSITIONS and time.monotonic() >= instance['ready_at']:
+            target = TRANSITIONS[instance['status']]
+            if target is None:
+                del self.instances[instance_id]
+                return None
+            instance['status'] = target
+        return instance
+
+    def _transition(self, instance_id, allowed, status):
+        instance = self._current(instance_id)
+        if instance is None:
+            return 404, {'errors': [{'message': 'Instance not found', 'reason': 'not-found'}]}
+        if instance['status'] not in allowed:
+            return 400, {'errors': [{'message': 'Instance is {}'.format(instance['status']),
+                                     'reason': 'invalid-state'}]}
+        instance['status'] = status
+        instance['ready_at'] = time.monotonic() + self.transition_delay
+        return 202, {'data': self._public(instance)}
+
+    def _public(self, instance, fields=None):
+        data = {k: v for k, v in instance.items() if k not in ['password', 'ready_at']}
+        if fields:
+            data = {k: v for k, v in data.items() if k in fields}
+        return data
+
+    def _rate_limited(self):
+        if not self.rate_limit:
+            return False
+        second = int(time.monotonic())
+        start, count = self.window
+        if start != second:
+            start, count = second, 0
+        self.window = (start, count + 1)
+        return count + 1 > self.rate_limit
+
+    # routing ---------------------------------------------------------------
+
+    def handle(self, method, path, query, body):
+        """Returns (http status, response body, extra headers)."""
+        route = re.sub(r'/instances/[^/]+', '/instances/{id}', path)
+        with self.lock:
+            self.requests[(method, route)] = self.requests.get((method, route), 0) + 1
+            if self._rate_limited():
+                return 429, {'errors': [{'message': 'Too many requests'}]}, {'Retry-After': '1'}
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, {'errors': [{'message': 'Injected error'}]}, {}
+
+        parts = [p for p in path.split('/') if p]
+        with self.lock:
+            if method == 'POST' and parts == ['oauth', 'token']:
+                return 200, {'access_token': 'simulated-' + str(time.time()), 'expires_in': 3600,
+                             'token_type': 'bearer'}, {}
+            if parts[:2] != ['v1', 'instances']:
+                return 404, {'errors': [{'message': 'Not found'}]}, {}
+            if len(parts) == 2 and method == 'GET':
+                fields = None if self.list_status else ['id', 'name', 'tenant_id', 'cloud_provider']
+                instances = [self._current(i) for i in list(self.instances)]
+                return 200, {'data': [self._public(d, fields) for d in instances if d]}, {}
+            if len(parts) == 2 and method == 'POST':
+                instance = self._new_instance(body.pop('name', ''), 'creating', **body)
+                data = self._public(instance)
+                data['password'] = instance['password']
+                return 202, {'data': data}, {}
+            instance_id = parts[2]
+            if len(parts) == 3 and method == 'GET':
+                instance = self._current(instance_id)
+                if instance is None:
+                    return 404, {'errors': [{'message': 'Instance not found'}]}, {}
+                return 200, {'data': self._public(instance)}, {}
+            if len(parts) == 3 and method == 'DELETE':
+                return self._transition(instance_id, ['running', 'paused', 'creating'], 'destroying') + ({},)
+            action = parts[3] if len(parts) > 3 else ''
+            if method == 'POST' and action == 'pause':
+                return self._transition(instance_id, ['running'], 'pausing') + ({},)
+            if method == 'POST' and action == 'resume':
+                return self._transition(instance_id, ['paused'], 'resuming') + ({},)
+            if method == 'POST' and action == 'overwrite':
+                return self._transition(instance_id, ['running'], 'overwriting') + ({},)
+            if method == 'GET' and action == 'snapshots':
+                if self._current(instance_id) is None:
+                    return 404, {'errors': [{'message': 'Instance not found'}]}, {}
+                date = query.get('date', [datetime.now(timezone.utc).date().isoformat()])[0]
+                return 200, {'data': [d for d in self.snapshots.get(instance_id, [])
+                                      if d['timestamp'].startswith(date)]}, {}
+        return 404, {'errors': [{'message': 'Not found'}]}, {}
+
+    def _handler(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately; don't let Nagle hold back the body
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _serve(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                raw = self.rfile.read(length) if length else b''
+                body = dict()
+                if raw and 'json' in self.headers.get('Content-Type', ''):
+                    body = json.loads(raw)
+                if simulator.latency:
+                    time.sleep(max(0.0, random.gauss(simulator.latency, simulator.latency * simulator.jitter)))
+                status, res, headers = simulator.handle(method, url.path, parse_qs(url.query), body)
+                simulator.record_response(status)
+                content = json.dumps(res).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(content)))
+                    for k, v in headers.items():
+                        self.send_header(k, v)
+                    self.end_headers()
+                    self.wfile.write(content)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client went away, e.g. a CLI run that was interrupted
+                    self.close_connection = True
+
+            def do_GET(self):
+                self._serve('GET')
+
+            def do_POST(self):
+                self._serve('POST')
+
+            def do_DELETE(self):
+                self._serve('DELETE')
+
+        return Handler
+
+
+if __name__ == '__main__':
+    args = cli()
+    simulator = AuraSimulator(port=args.port, latency=args.latency, jitter=args.jitter,
+                              transition_delay=args.transition_delay, rate_limit=args.rate_limit,
+                              error_rate=args.error_rate, list_status=args.list_status)
+    logger.info("Aura API simulator listening on {}".format(simulator.url))
+    logger.info('Point "endpoint" at {0}/v1/instances and "auth.endpoint" at {0}/oauth/token'.format(simulator.url))
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        simulator.server.server_close()
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import bisect
+import logging
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+
+from fleet import map_concurrently
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# A day's snapshot list is final once it was fetched this long after the day ended (UTC)
+SETTLE_TIME = 3600
+
+
+def date_range(end_date=None, days=1):
+    """`days` ISO dates ending with `end_date` (default: today, UTC), newest first."""
+    end = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else datetime.now(timezone.utc).date()
+    return [(end - timedelta(days=i)).isoformat() for i in range(max(1, days))]
+
+
+def _day_end(date):
+    day = datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return (day + timedelta(days=1)).timestamp()
+
+
+class SnapshotCatalogue:
+    """Snapshots of instances by day, cached and indexed by instance, status and timestamp.
+
+    The snapshot lists of the requested days are fetched in parallel. A list fetched
+    well after its day ended will not change any more and is kept for good; the list of
+    the current day is refetched after `ttl` seconds. With `cache_file` set, the lists
+    are kept on disk, so repeated clone runs do not ask the API again.
+    """
+
+    def __init__(self, api, cache_file=None, ttl=300, workers=8):
+        self.api = api
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.days = dict()
+        self.index = dict()
+        self._load()
+
+    def _fresh(self, date, fetched_at):
+        if fetched_at >= _day_end(date) + SETTLE_TIME:
+            return True
+        return bool(self.ttl) and time.time() - fetched_at < self.ttl
+
+    def _index(self, instance_id):
+        """Rebuild the per-status (timestamps, snapshots) lists of one instance, oldest first."""
+        by_status = {None: []}
+        for (cached_instance_id, _), (snapshots, _) in self.days.items():
+            if cached_instance_id != instance_id:
+                continue
+            for snapshot in snapshots:
+                by_status[None].append(snapshot)
+                by_status.setdefault(snapshot.get('status'), []).append(snapshot)
+        self.index[instance_id] = dict()
+        for status, snapshots in by_status.items():
+            snapshots.sort(key=lambda d: (d.get('timestamp', ''), d.get('snapshot_id', '')))
+            self.index[instance_id][status] = ([d.get('timestamp', '') for d in snapshots], snapshots)
+
+    def fetch(self, instance_id, dates):
+        """Fetch the snapshot lists of `dates` that are not cached yet, in parallel."""
+        with self.lock:
+            missing = [d for d in dates if not self._fresh(d, self.days.get((instance_id, d), ([], 0.0))[1])]
+        if not missing:
+            return
+        logger.info("Fetching snapshots of {} for {} day(s)".format(instance_id, len(missing)))
+        fetched = dict()
+        for date, snapshots in map_concurrently(lambda d: self.api.snapshots(instance_id, d), missing,
+                                                workers=self.workers):
+            # 'Unknown' when the API returned no list, e.g. for a paused instance; not cached
+            if isinstance(snapshots, list):
+                fetched[date] = snapshots
+        with self.lock:
+            for date, snapshots in fetched.items():
+                self.days[(instance_id, date)] = (snapshots, time.time())
+            self._index(instance_id)
+            self._save()
+
+    def query(self, instance_id, dates, status=None):
+        """Snapshots of `instance_id` taken on `dates`, newest first, optionally only with `status`."""
+        self.fetch(instance_id, dates)
+        first, last = min(dates), max(dates)
+        with self.lock:
+            timestamps, snapshots = self.index.get(instance_id, {}).get(status or None, ([], []))
+            # ISO timestamps sort as strings; every timestamp of a day sorts between these two
+            start = bisect.bisect_left(timestamps, first)
+            end = bisect.bisect_right(timestamps, last + 'T\uffff')
+            return [dict(d) for d in reversed(snapshots[start:end])]
+
+    def latest(self, instance_id, dates, status='Completed'):
+        """Newest snapshot with `status` taken on one of `dates`, or None.
+
+        Snapshots with the same timestamp are ordered by id, so the pick is stable.
+        """
+        snapshots = self.query(instance_id, dates, status=status)
+        return snapshots[0] if snapshots else None
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+            self.days = {tuple(key.split('/', 1)): tuple(value) for key, value in data.get('days', {}).items()}
+            for instance_id in {instance_id for instance_id, _ in self.days}:
+                self._index(instance_id)
+        except (OSError, ValueError) as e:
+            logger.info("Ignoring unreadable snapshot cache: {} {}".format(self.cache_file, e))
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        data = {'days': {'/'.join(key): value for key, value in self.days.items()}}
+        # a temp file of its own, since shards of one tenant share the cache file
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(self.cache_file) or '.',
+                                        prefix=os.path.basename(self.cache_file) + '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_file, self.cache_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
@@ -0,0 +1,68 @@
+from reconcile import plan
+
+
+def instance(name, status='running', **details):
+    return dict(details, id='id-' + name, name=name, status=status)
+
+
+def actions_by_name(actions):
+    return {a['name']: a['action'] for a in actions}
+
+
+def test_fleet_in_target_state_needs_no_actions():
+    instances = [instance('wkshp_a'), instance('wkshp_b', status='resuming')]
+    assert plan(instances, 'wkshp', 2) == []
+
+
+def test_scale_up_picks_new_names_with_the_prefix():
+    instances = [instance('wkshp_a')]
+    actions = plan(instances, 'wkshp', 3, existing_names=['wkshp_a', 'other_x'])
+    assert [a['action'] for a in actions] == ['create', 'create']
+    assert all(a['name'].startswith('wkshp_') and a['name'] != 'wkshp_a' for a in actions)
+
+
+def test_scale_down_deletes_instances_not_in_the_target_state_first():
+    instances = [instance('wkshp_a'), instance('wkshp_b', status='paused'), instance('wkshp_c')]
+    actions = plan(instances, 'wkshp', 2)
+    assert actions_by_name(actions) == {'wkshp_b': 'delete'}
+    assert actions[0]['reason'] == 'scale down'
+
+
+def test_pause_and_resume_towards_the_target_state():
+    instances = [instance('wkshp_a', status='paused'), instance('wkshp_b')]
+    assert actions_by_name(plan(instances, 'wkshp', 2)) == {'wkshp_a': 'resume'}
+    assert actions_by_name(plan(instances, 'wkshp', 2, state='paused')) == {'wkshp_b': 'pause'}
+
+
+def test_instances_being_deleted_are_replaced():
+    instances = [instance('wkshp_a'), instance('wkshp_b', status='destroying')]
+    actions = plan(instances, 'wkshp', 2)
+    assert [a['action'] for a in actions] == ['create']
+
+
+def test_mismatched_instances_are_kept_unless_replaced():
+    instances = [instance('wkshp_a', memory='2GB'), instance('wkshp_b', memory='4GB')]
+    params = {'memory': '4GB'}
+    assert plan(instances, 'wkshp', 2, params=params) == []
+    actions = plan(instances, 'wkshp', 2, params=params, replace_mismatched=True)
+    assert [(a['action'], a['name']) for a in actions][0] == ('delete', 'wkshp_a')
+    assert [a['action'] for a in actions][1:] == ['create']
+
+
+def test_only_instances_named_prefix_underscore_belong_to_the_fleet():
+    # `wkshp2_...` and `wkshpx` share the first characters but are not part of the `wkshp` fleet
+    instances = [instance('wkshp_a'), instance('wkshp2_b', status='paused'), instance('wkshpx', status='paused')]
+    assert plan(instances, 'wkshp', 1) == []
+    assert actions_by_name(plan(instances, 'wkshp', 0)) == {'wkshp_a': 'delete'}
+
+
+def test_instances_with_a_failed_status_lookup_are_never_deleted():
+    instances = [instance('wkshp_a', status=None), instance('wkshp_b'), instance('wkshp_c', status='paused')]
+    actions = plan(instances, 'wkshp', 1)
+    assert actions_by_name(actions) == {'wkshp_b': 'delete', 'wkshp_c': 'delete'}
+    assert plan(instances[:1], 'wkshp', 0) == []
+
+
+def test_instances_with_a_failed_status_lookup_count_as_seats():
+    instances = [instance('wkshp_a', status=None, memory='2GB')]
+    assert plan(instances, 'wkshp', 1, state='paused', params={'memory': '4GB'}, replace_mismatched=True) == []
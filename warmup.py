@@ -0,0 +1,161 @@
+import time
+import argparse
+import logging
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+
+from records import read_records, RecordWriter
+from metrics import percentile
+from bolt import SocketLimit, open_driver, probe
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+WARMUP_FIELDS = ['id', 'name', 'connection_url', 'warm', 'warmup_s', 'first_query_s', 'second_query_s', 'error']
+
+# Reads every node and relationship with its properties, so the store files end up in the page cache
+DEFAULT_SCRIPT = '''
+MATCH (n) RETURN count(properties(n));
+MATCH ()-[r]->() RETURN count(properties(r));
+'''
+# Timed before and after the script; read-only, since a script statement may not be safe to run twice
+DEFAULT_LATENCY_QUERY = 'MATCH (n) WITH n LIMIT 1000 RETURN count(properties(n))'
+
+
+def cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, help="filename of csv with the instance credentials")
+    parser.add_argument('--script', default='', help="Cypher file with the warm-up statements, separated by ';' "
+                                                     "(default: scan all nodes and relationships)")
+    parser.add_argument('--latency-query', default=DEFAULT_LATENCY_QUERY,
+                        help="read-only query timed on the cold and on the warm instance")
+    parser.add_argument('--database', default='neo4j', help="database to warm up")
+    parser.add_argument('--workers', type=int, default=8, help="number of instances warmed up in parallel")
+    parser.add_argument('--max-sockets', type=int, default=None,
+                        help="most Bolt connections open at once (default: --workers)")
+    parser.add_argument('--connect-timeout', type=float, default=5, help="seconds before an instance counts as down")
+    parser.add_argument('--retries', type=int, default=2, help="retries for instances that are still starting")
+    return parser.parse_args()
+
+
+def read_script(filename=''):
+    """Statements of a Cypher script, split on ';'. Lines starting with '//' are comments."""
+    text = DEFAULT_SCRIPT
+    if filename:
+        with open(filename, 'r') as f:
+            text = f.read()
+    lines = [line for line in text.splitlines() if not line.strip().startswith('//')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
+def credentials(filename):
+    """Rows of the credentials CSV with the password that currently works.
+
+    If readable_passwords.py has rotated an instance, its `_readable_pw` row and new
+    password are used; otherwise the row and password of `filename`.
+    """
+    readable_pw_file = path.splitext(filename)[0] + '_readable_pw.csv'
+    rotated = dict()
+    if path.exists(readable_pw_file):
+        rotated = {row['id']: row for row in read_records(readable_pw_file) if row.get('rotated') == 'True'}
+    for row in read_records(filename):
+        if row['id'] in rotated:
+            row = dict(rotated[row['id']], password=rotated[row['id']]['newpassword'])
+        yield row
+
+
+def warm_up(uri, auth, statements, database='neo4j', retries=2, retry_delay=10, sockets=None,
+            connection_timeout=5, latency_query=DEFAULT_LATENCY_QUERY):
+    """Run the warm-up `statements` on one instance, with `latency_query` before and after.
+
+    Returns the seconds the whole script took, the latency of `latency_query` on the
+    cold instance and once warm, plus an error message ('' on success). Instances
+    that are not reachable yet are retried like in rotate_password.
+    """
+    from neo4j.exceptions import ServiceUnavailable, SessionExpired
+
+    sockets = sockets or SocketLimit()
+    error = ''
+    try:
+        driver = open_driver(uri, auth, connection_timeout=connection_timeout)
+    except Exception as e:
+        # e.g. a malformed connection_url: this instance fails, the others go on
+        return None, None, None, str(e)
+    with driver:
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(retry_delay * attempt)
+            try:
+                with sockets, driver.session(database=database) as session:
+                    probe(session)
+                    first = time.perf_counter()
+                    session.run(latency_query).consume()
+                    first = time.perf_counter() - first
+
+                    start = time.perf_counter()
+                    for statement in statements:
+                        session.run(statement).consume()
+                    warmup = time.perf_counter() - start
+
+                    second = time.perf_counter()
+                    session.run(latency_query).consume()
+                    second = time.perf_counter() - second
+                return warmup, first, second, ''
+            except (ServiceUnavailable, SessionExpired) as e:
+                error = str(e)
+                logger.info("Instance not reachable yet, retrying: {} {}".format(uri, error))
+            except Exception as e:
+                return None, None, None, str(e)
+    return None, None, None, error
+
+
+def warm_up_instances(filename, script='', database='neo4j', workers=8, max_sockets=None, connection_timeout=5,
+                      retries=2, latency_query=DEFAULT_LATENCY_QUERY):
+    """Warm up every instance in the credentials CSV; writes one row each to `_warmup.csv`."""
+    statements = read_script(script)
+    if not statements:
+        raise ValueError("No statements in the warm-up script {}".format(script))
+    warmup_file = path.splitext(filename)[0] + '_warmup.csv'
+    sockets = SocketLimit(workers if max_sockets is None else max_sockets)
+
+    def _warm_up(row):
+        auth = (row.get('username') or 'neo4j', row['password'])
+        warmup, first, second, error = warm_up(row['connection_url'], auth, statements, database=database,
+                                               retries=retries, sockets=sockets,
+                                               connection_timeout=connection_timeout, latency_query=latency_query)
+        result = {'id': row['id'], 'name': row.get('name', ''), 'connection_url': row['connection_url'],
+                  'warm': 'False' if error else 'True', 'error': error}
+        if not error:
+            result.update({'warmup_s': round(warmup, 3), 'first_query_s': round(first, 3),
+                           'second_query_s': round(second, 3)})
+        logger.info("{} {}: {}".format(row['id'], row['connection_url'], error or
+                                       'warm in {:.1f}s, latency query {:.3f}s cold, {:.3f}s warm'.format(
+                                           warmup, first, second)))
+        return result
+
+    results = list()
+    with RecordWriter(warmup_file, WARMUP_FIELDS) as writer, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for result in executor.map(_warm_up, credentials(filename)):
+            writer.write(result)
+            results.append(result)
+
+    warm = [r for r in results if r['warm'] == 'True']
+    logger.info("Instances warmed up: {}, failed: {}".format(len(warm), len(results) - len(warm)))
+    if warm:
+        for field in ['warmup_s', 'first_query_s', 'second_query_s']:
+            values = [r[field] for r in warm]
+            logger.info("{}: p50 {:.3f}s, p90 {:.3f}s, max {:.3f}s".format(
+                field, percentile(values, 0.5), percentile(values, 0.9), max(values)))
+        slowest = sorted(warm, key=lambda r: r['warmup_s'], reverse=True)[:5]
+        logger.info("Slowest: {}".format(', '.join('{} {}s'.format(r['id'], r['warmup_s']) for r in slowest)))
+    return results
+
+
+if __name__ == '__main__':
+    args = cli()
+    start = time.time()
+    warm_up_instances(args.filename, script=args.script, database=args.database, workers=args.workers,
+                      max_sockets=args.max_sockets, connection_timeout=args.connect_timeout, retries=args.retries,
+                      latency_query=args.latency_query)
+    logger.info("Time to warm up instances: {}s".format(time.time() - start))
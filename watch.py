@@ -0,0 +1,246 @@
+import sys
+import time
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from fleet import map_concurrently
+from bolt import SocketLimit, open_driver, probe
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level='INFO')
+
+# Statuses that only change when someone acts; instances in them are looked up last
+SETTLED = ['running', 'paused']
+
+
+def probe_instance(uri, auth, connection_timeout=5.0, sockets=None):
+    """Round trip of `RETURN 1` in milliseconds, or None if the instance cannot be reached."""
+    try:
+        with sockets or SocketLimit(), open_driver(uri, auth, connection_timeout=connection_timeout) as driver, \
+                driver.session() as session:
+            return round(probe(session) * 1000)
+    except Exception as e:
+        logger.debug("Probe failed: {} {}".format(uri, e))
+        return None
+
+
+class RedrawOnLog(logging.Handler):
+    """Makes the watch draw the whole table again after a log line scrolled it up."""
+
+    def __init__(self, watch):
+        super().__init__()
+        self.watch = watch
+
+    def emit(self, record):
+        self.watch.drawn = 0
+
+
+class FleetWatch:
+    """Live view of the status of a fleet, refreshed from one `list` call per interval.
+
+    On a terminal the table is redrawn in place, rewriting only the rows that changed;
+    otherwise the changed rows are printed as they change. The list endpoint does not
+    always report status. Those instances are looked up individually, at most
+    `lookups` per tick: instances never checked first, then the ones in a
+    transitional status, then the ones looked up longest ago. With `credentials`
+    (rows with id, connection_url, username and password), running instances also
+    get a Bolt probe every tick.
+    """
+
+    def __init__(self, api, select, interval=5, lookups=20, target='running', slowest=5, credentials=None,
+                 workers=8, connection_timeout=5, stream=None):
+        self.api = api
+        self.select = select
+        self.interval = interval
+        self.lookups = lookups
+        self.target = target
+        self.slowest = slowest
+        self.credentials = {row['id']: row for row in credentials or []}
+        self.workers = workers
+        self.connection_timeout = connection_timeout
+        self.sockets = SocketLimit(workers)
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.instances = dict()
+        self.order = list()
+        self.looked_up = dict()
+        self.start_time = time.time()
+        self.ticks = 0
+        self.calls = 0
+        self.drawn = 0
+
+    def refresh(self):
+        """Poll the fleet once; returns the ids of the instances whose row changed."""
+        now = time.time()
+        listed = {d['id']: d for d in self.api.list(refresh=True)}
+        self.calls += 1
+        selected = self.select(list(listed.values()))
+        # configured instance_ids are selected whether or not they exist
+        unlisted = [instance_id for instance_id in selected if instance_id not in listed]
+        selected = [instance_id for instance_id in selected if instance_id in listed]
+        statuses = {instance_id: listed[instance_id].get('status') for instance_id in selected}
+
+        missing = [instance_id for instance_id in selected if not statuses.get(instance_id)]
+        missing.sort(key=lambda i: (i in self.instances,
+                                    self.instances.get(i, {}).get('status') in SETTLED,
+                                    self.looked_up.get(i, 0)))
+        batch = missing[:self.lookups] if self.lookups else missing
+        for instance_id, status in map_concurrently(lambda i: self.api.status(i, refresh=True), batch,
+                                                    workers=self.workers):
+            # a failed lookup keeps the last known status
+            statuses[instance_id] = status
+            self.looked_up[instance_id] = now
+        self.calls += len(batch)
+
+        changed = set()
+        for instance_id in selected:
+            # instances not looked up this tick keep their last known status
+            status = statuses.get(instance_id) or self.instances.get(instance_id, {}).get('status') or 'unchecked'
+            changed |= self._update(instance_id, listed[instance_id].get('name', ''), status, now)
+        for instance_id in unlisted:
+            if instance_id not in self.instances:
+                changed |= self._update(instance_id, '', 'unknown', now)
+        for instance_id in self.order:
+            if instance_id not in listed and self.instances[instance_id]['status'] not in ['deleted', 'unknown']:
+                changed |= self._update(instance_id, self.instances[instance_id]['name'], 'deleted', now)
+
+        if self.credentials:
+            changed |= self._probe([i for i in self.order if self.instances[i]['status'] == 'running'])
+        self.ticks += 1
+        return changed
+
+    def _update(self, instance_id, name, status, now):
+        instance = self.instances.get(instance_id)
+        if instance is None:
+            self.order.append(instance_id)
+            self.instances[instance_id] = {'instance_id': instance_id, 'name': name, 'status': status,
+                                           'since': now, 'previous': '', 'probe_ms': ''}
+            return {instance_id}
+        if instance['status'] == status:
+            return set()
+        previous = '' if instance['status'] == 'unchecked' else instance['status']
+        instance.update({'previous': previous, 'status': status, 'since': now, 'probe_ms': ''})
+        return {instance_id}
+
+    def _probe(self, instance_ids):
+        def _run(instance_id):
+            row = self.credentials.get(instance_id)
+            if not row:
+                return ''
+            latency = probe_instance(row['connection_url'], (row.get('username') or 'neo4j', row['password']),
+                                     connection_timeout=self.connection_timeout, sockets=self.sockets)
+            return 'down' if latency is None else latency
+
+        changed = set()
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            for instance_id, latency in zip(instance_ids, executor.map(_run, instance_ids)):
+                shown = self.instances[instance_id]['probe_ms']
+                # redraw on up/down changes, or when the latency moved by more than half
+                if isinstance(latency, int) and isinstance(shown, int) and abs(latency - shown) <= shown / 2:
+                    continue
+                if latency != shown:
+                    self.instances[instance_id]['probe_ms'] = latency
+                    changed.add(instance_id)
+        return changed
+
+    def counts(self):
+        statuses = [instance['status'] for instance in self.instances.values()]
+        return [(status, statuses.count(status)) for status in sorted(set(statuses))]
+
+    def pending(self):
+        # 'unknown': a configured id that was never listed, which will not reach the target either
+        return [i for i in self.instances.values() if i['status'] not in [self.target, 'deleted', 'unknown']]
+
+    def stragglers(self):
+        """The instances longest out of the `target` status, with their seconds in their current status."""
+        now = time.time()
+        pending = sorted(self.pending(), key=lambda i: i['since'])
+        return [(instance, now - instance['since']) for instance in pending[:self.slowest]]
+
+    def done(self):
+        return bool(self.instances) and not self.pending()
+
+    def header(self):
+        lines = ["Watching {} instances ({:.0f}s, {} API calls in {} ticks)".format(
+            len(self.instances), time.time() - self.start_time, self.calls, self.ticks)]
+        lines.append('  ' + ', '.join('{} {}'.format(status, count) for status, count in self.counts()))
+        stragglers = self.stragglers()
+        lines.append("  Slowest to reach {}:".format(self.target) if stragglers else '')
+        for index in range(self.slowest):
+            if index < len(stragglers):
+                instance, seconds = stragglers[index]
+                lines.append("    {:<10} {:<28} {:<12} {:>6.0f}s".format(
+                    instance['instance_id'], instance['name'][:28], instance['status'], seconds))
+            else:
+                lines.append('')
+        lines.append("{:<10} {:<28} {:<12} {:<12} {:<9} {:>8}".format(
+            'instance_id', 'name', 'status', 'previous', 'since', 'probe_ms'))
+        return lines
+
+    def row(self, instance_id):
+        instance = self.instances[instance_id]
+        return "{:<10} {:<28} {:<12} {:<12} {:<9} {:>8}".format(
+            instance_id, instance['name'][:28], instance['status'], instance['previous'],
+            time.strftime('%H:%M:%S', time.localtime(instance['since'])), instance['probe_ms'])
+
+    def render(self, changed):
+        header = self.header()
+        height = len(header) + len(self.order)
+        if not self.tty or height >= shutil.get_terminal_size().lines:
+            # not enough room to redraw in place: print the changed rows and the new counts
+            if not changed:
+                return
+            for instance_id in self.order:
+                if instance_id in changed:
+                    self.stream.write(self.row(instance_id) + '\n')
+            self.stream.write(header[1].strip() + '\n')
+            self.stream.flush()
+            self.drawn = 0
+            return
+
+        if not self.drawn or height != self.drawn:
+            # first draw, or instances were added: draw everything
+            if self.drawn:
+                self.stream.write('\x1b[{}F\x1b[J'.format(self.drawn))
+            self.stream.write('\n'.join(header + [self.row(i) for i in self.order]) + '\n')
+        else:
+            # the header every tick, and only the rows that changed
+            lines = [(index, line) for index, line in enumerate(header)]
+            lines += [(len(header) + index, self.row(i)) for index, i in enumerate(self.order) if i in changed]
+            for index, line in lines:
+                self.stream.write('\x1b[{}F\x1b[2K{}\n'.format(height - index, line))
+                if height - index - 1:
+                    self.stream.write('\x1b[{}E'.format(height - index - 1))
+        self.stream.flush()
+        self.drawn = height
+
+    def run(self, duration=0, stop_at_target=False):
+        """Refresh every `interval` seconds until Ctrl-C, `duration` seconds (0: no limit) or,
+        with `stop_at_target`, until every instance has the target status. Returns the rows."""
+        deadline = time.monotonic() + duration if duration else None
+        # log lines go to the terminal too; the rows under them would be redrawn in the wrong place
+        redraw = RedrawOnLog(self)
+        if self.tty:
+            logging.getLogger().addHandler(redraw)
+        try:
+            while True:
+                tick = time.monotonic()
+                try:
+                    self.render(self.refresh())
+                except Exception as e:
+                    # e.g. a failed list call; the table shows the last known statuses until the next tick
+                    logger.error("Watch tick failed, trying again in {}s: {}".format(self.interval, e))
+                if stop_at_target and self.done():
+                    break
+                if deadline and time.monotonic() >= deadline:
+                    break
+                time.sleep(max(0.0, self.interval - (time.monotonic() - tick)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logging.getLogger().removeHandler(redraw)
+        logger.info("Watched {} instances for {:.0f}s with {} API calls".format(
+            len(self.instances), time.time() - self.start_time, self.calls))
+        return [dict(self.instances[i], since=time.strftime('%H:%M:%S', time.localtime(self.instances[i]['since'])))
+                for i in self.order]